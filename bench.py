@@ -0,0 +1,308 @@
+# Замеры производительности парсера на синтетических данных, без Telegram.
+# Запуск: python bench.py [all|parse|convert|codec|bloom] [--channels N] [--posts N] [--flood P] ..., полный список: --help
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import logging
+import argparse
+import resource
+import tempfile
+import tracemalloc
+from types import SimpleNamespace
+from datetime import datetime
+
+# pars.py читает настройки при импорте; для замеров хватает заглушек
+os.environ.setdefault('API_TOKEN', '123456:bench')
+os.environ.setdefault('API_ID', '1')
+os.environ.setdefault('API_HASH', 'bench')
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import pars
+from pyrogram.errors import FloodWait
+
+
+class FakeClient:
+    # Вместо Telegram: синтетические каналы с постами и комментариями, чаты с участниками.
+    # flood - доля запросов, на которые отвечаем FLOOD_WAIT на flood_seconds секунд
+    def __init__(self, posts=100, comments=20, members=1000, users_pool=50000, flood=0.0, flood_seconds=0, latency=0.0, seed=1):
+        self.posts = posts
+        self.comments = comments
+        self.members = members
+        self.users_pool = users_pool
+        self.flood = flood
+        self.flood_seconds = flood_seconds
+        self.latency = latency
+        self.rnd = random.Random(seed)
+        self.calls = {}
+        self.is_connected = False
+
+    async def call(self, method):
+        self.calls[method] = self.calls.get(method, 0) + 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self.flood and self.rnd.random() < self.flood:
+            raise FloodWait(value=self.flood_seconds)
+
+    def user(self, chat_id, n):
+        user_id = 10 ** 8 + (chat_id * 7919 + n * 104729) % self.users_pool
+        return SimpleNamespace(id=user_id, username=f"user{user_id}", phone_number=None)
+
+    async def start(self):
+        self.is_connected = True
+
+    async def stop(self):
+        self.is_connected = False
+
+    async def get_me(self):
+        await self.call('get_me')
+        return SimpleNamespace(id=1)
+
+    async def get_chat(self, username):
+        await self.call('get_chat')
+        return SimpleNamespace(id=sum(map(ord, str(username))), username=username)
+
+    async def get_messages(self, chat_id, message_ids):
+        await self.call('get_messages')
+        return SimpleNamespace(id=message_ids, empty=False, service=None, replies=self.comments, date=datetime.now())
+
+    async def get_chat_history(self, chat_id, limit=0, offset_id=0):
+        newest = offset_id - 1 if offset_id else self.posts
+        count = 0
+        for message_id in range(newest, 0, -1):
+            if limit and count >= limit:
+                return
+            if count % 100 == 0:
+                await self.call('get_chat_history')
+            count += 1
+            # Как в Pyrogram 2.0.106: счетчика комментариев (replies) у поста из истории нет
+            yield SimpleNamespace(id=message_id, empty=False, service=None, date=datetime.now())
+
+    async def get_discussion_replies(self, chat_id, message_id):
+        for n in range(self.comments):
+            if n % 100 == 0:
+                await self.call('get_discussion_replies')
+            yield SimpleNamespace(id=self.comments - n, from_user=self.user(chat_id + message_id, n))
+
+    async def get_chat_members(self, chat_id):
+        for n in range(self.members):
+            if n % 200 == 0:
+                await self.call('get_chat_members')
+            yield SimpleNamespace(user=self.user(sum(map(ord, str(chat_id))), n))
+
+
+class FakeBot:
+    # Любой метод Bot API считается и отвечает сообщением-заглушкой
+    def __init__(self):
+        self.calls = {}
+
+    def __getattr__(self, method):
+        async def call(*args, **kwargs):
+            self.calls[method] = self.calls.get(method, 0) + 1
+            return SimpleNamespace(message_id=1, photo=[SimpleNamespace(file_id='bench')])
+        return call
+
+
+def make_base(path, lines, updates=0.2):
+    # Журнал базы: lines записей, часть из них - повторные версии уже записанных пользователей
+    rnd = random.Random(1)
+    users_count = int(lines * (1 - updates)) or 1
+    with open(path, 'w') as f:
+        for i in range(lines):
+            user_id = rnd.randrange(users_count) + 10 ** 8 if i >= users_count else i + 10 ** 8
+            record = {"user_id": user_id}
+            if rnd.random() < 0.8:
+                record["username"] = f"user{user_id}_{i % 7}"
+            if rnd.random() < 0.1:
+                record["phone"] = f"+7999{user_id % 10 ** 7:07d}"
+            f.write(json.dumps(record) + '\n')
+
+
+def bench_convert(args):
+    lines, workers = args.lines, args.workers
+    store = pars.UserStore(pars.full_base_file, pars.full_base_index_file)
+    make_base(pars.full_base_file, lines)
+    store.load()
+    print(f"База: {lines} строк, {len(store)} пользователей, {store.size / 2 ** 20:.1f} МБ")
+
+    started = time.perf_counter()
+    pars.export_users(store.iter_records(), 'single.txt', separator='\t', require_username=True, ids='matched')
+    single = time.perf_counter() - started
+    print(f"Один процесс:   {lines / single:12.0f} строк/сек ({single:.2f} сек)")
+
+    pars.bulk_workers = workers
+    pars.bulk_min_size = 0
+    started = time.perf_counter()
+    pars.export_base(store, 'bulk.txt', separator='\t', require_username=True, ids='matched')
+    bulk = time.perf_counter() - started
+    print(f"{workers} процессов:   {lines / bulk:12.0f} строк/сек ({bulk:.2f} сек), x{single / bulk:.1f}")
+
+    with open('single.txt', 'rb') as a, open('bulk.txt', 'rb') as b:
+        print("Результаты совпадают" if a.read() == b.read() else "ОШИБКА: выгрузки отличаются")
+
+    # Точечные запросы "что известно о пользователе" по индексу
+    rnd = random.Random(2)
+    user_ids = [rnd.randrange(len(store)) + 10 ** 8 for _ in range(100000)]
+    started = time.perf_counter()
+    for user_id in user_ids:
+        store.get(user_id)
+        store.cache.pop(user_id, None)
+    lookups = time.perf_counter() - started
+    print(f"Поиск по id:    {len(user_ids) / lookups:12.0f} запросов/сек")
+    store.close()
+
+
+def legacy_encode(store, user_id, info):
+    # Кодирование строки базы до появления encode_record
+    user_data = {"user_id": user_id, "username": info.get('username'), "phone": info.get('phone')}
+    return (json.dumps({k: v for k, v in user_data.items() if v is not None}) + '\n').encode()
+
+
+def bench_store(users_count):
+    # Сохранение всех пользователей в журнал и полная загрузка журнала без индекса
+    store = pars.UserStore(pars.full_base_file, pars.full_base_index_file)
+    store.load()
+    for user_id in range(10 ** 8, 10 ** 8 + users_count):
+        store.update(user_id, f"user{user_id}", f"+7999{user_id % 10 ** 7:07d}" if user_id % 10 == 0 else None)
+
+    started = time.perf_counter()
+    store.flush()
+    save = time.perf_counter() - started
+
+    if os.path.exists(pars.full_base_index_file):
+        os.remove(pars.full_base_index_file)
+    started = time.perf_counter()
+    store.load()
+    load = time.perf_counter() - started
+
+    with open(pars.full_base_file, 'rb') as f:
+        data = f.read()
+    store.delete()
+    return save, load, data
+
+
+def bench_codec(args):
+    users_count = args.users
+    fast_loads, fast_encode = pars.json_loads, pars.UserStore.encode
+    print(f"Кодек чтения: {'orjson' if pars.orjson else 'json'}, {users_count} пользователей")
+    results = {}
+    for name, loads, encode in (('json', json.loads, legacy_encode), ('кодек', fast_loads, fast_encode)):
+        pars.json_loads, pars.UserStore.encode = loads, encode
+        results[name] = bench_store(users_count)
+        save, load, _ = results[name]
+        print(f"{name:>6}: сохранение {users_count / save:10.0f} польз/сек ({save:.2f} сек), "
+              f"загрузка {users_count / load:10.0f} польз/сек ({load:.2f} сек)")
+    pars.json_loads, pars.UserStore.encode = fast_loads, fast_encode
+    print("Файлы совпадают" if results['json'][2] == results['кодек'][2] else "ОШИБКА: файлы отличаются")
+
+
+def bench_bloom(args):
+    # Старт базы по фильтру Блума без чтения индекса и восстановление, если индекс потерян
+    lines = args.lines
+    make_base(pars.full_base_file, lines)
+    store = pars.UserStore(pars.full_base_file, pars.full_base_index_file, pars.full_base_bloom_file)
+    store.load()
+    store.save()
+    users_count = len(store)
+    print(f"База: {lines} строк, {users_count} пользователей")
+
+    started = time.perf_counter()
+    store = pars.UserStore(pars.full_base_file, pars.full_base_index_file)
+    store.load()
+    full = time.perf_counter() - started
+    started = time.perf_counter()
+    store = pars.UserStore(pars.full_base_file, pars.full_base_index_file, pars.full_base_bloom_file)
+    store.load()
+    lazy = time.perf_counter() - started
+    print(f"Загрузка с индексом: {full:.3f} сек, по фильтру: {lazy:.3f} сек")
+
+    rnd = random.Random(3)
+    user_ids = [rnd.randrange(10 ** 9, 2 * 10 ** 9) for _ in range(100000)]
+    false_positives = sum(1 for user_id in user_ids if user_id in store.bloom)
+    print(f"Ложных срабатываний фильтра: {false_positives / len(user_ids):.2%}, индекс прочитан: {store.index_loaded}")
+
+    os.remove(pars.full_base_index_file)
+    store = pars.UserStore(pars.full_base_file, pars.full_base_index_file, pars.full_base_bloom_file)
+    store.load()
+    store.update(10 ** 8, 'bench', None)
+    store.save()
+    store = pars.UserStore(pars.full_base_file, pars.full_base_index_file, pars.full_base_bloom_file)
+    store.load()
+    print("Без индекса база восстановлена" if len(store) == users_count else f"ОШИБКА: после потери индекса {len(store)} из {users_count}")
+    store.close()
+
+
+def bench_parse(args):
+    # Полный запуск execute_parsing на фейковом Telegram: каналы, затем чаты
+    client = FakeClient(
+        posts=args.posts, comments=args.comments, members=args.members, users_pool=args.users_pool,
+        flood=args.flood, flood_seconds=args.flood_seconds, latency=args.latency
+    )
+    pars.session_pool = pars.SessionPool([f"bench{i}" for i in range(args.accounts)])
+    for account in pars.session_pool.accounts:
+        account.client = account.manager.client = client
+        for limiter in account.limiters.values():
+            # Лимиты Telegram не меряем: темп задается параметром, FLOOD_WAIT все равно его снижает
+            limiter.rate = limiter.max_rate = args.rate
+            limiter.min_rate = args.rate / 16
+            limiter.burst = limiter.tokens = max(1, int(args.rate))
+    pars.bot = FakeBot()
+    pars.channels = {f"channel{i}": True for i in range(args.channels)}
+    pars.chats = {f"chat{i}": True for i in range(args.chats)}
+    pars.channels_state = {}
+    pars.parsing_in_progress = True
+
+    if args.trace_memory:
+        tracemalloc.start()
+    started = time.perf_counter()
+    asyncio.run(pars.execute_parsing(limit=args.posts, incremental=False))
+    elapsed = time.perf_counter() - started
+    peak = tracemalloc.get_traced_memory()[1] if args.trace_memory else None
+    tracemalloc.stop()
+
+    found = pars.parsed_users_count
+    calls = sum(client.calls.values())
+    print(f"Каналов: {args.channels} x {args.posts} постов x {args.comments} комментариев, чатов: {args.chats} x {args.members}")
+    print(f"Найдено пользователей: {found}, новых: {len(pars.new_users)}, за {elapsed:.2f} сек ({found / elapsed:.0f} польз/сек)")
+    print(f"Запросов к Telegram: {calls} ({calls / max(found, 1):.3f} на пользователя): {client.calls}")
+    print(f"Сэкономлено запросов: {pars.saved_requests_count}")
+    if peak is not None:
+        print(f"Пиковая память Python: {peak / 2 ** 20:.1f} МБ")
+    print(f"Пиковый RSS процесса: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f} МБ")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('bench', nargs='?', choices=('all', 'parse', 'convert', 'codec', 'bloom'), default='all')
+    parser.add_argument('--channels', type=int, default=10)
+    parser.add_argument('--posts', type=int, default=200)
+    parser.add_argument('--comments', type=int, default=30)
+    parser.add_argument('--chats', type=int, default=3)
+    parser.add_argument('--members', type=int, default=5000)
+    parser.add_argument('--users-pool', type=int, default=50000, help="сколько разных пользователей в фейковом Telegram")
+    parser.add_argument('--accounts', type=int, default=1)
+    parser.add_argument('--rate', type=float, default=1000.0, help="запросов в секунду на семейство методов")
+    parser.add_argument('--flood', type=float, default=0.0, help="доля запросов с FLOOD_WAIT")
+    parser.add_argument('--flood-seconds', type=int, default=0)
+    parser.add_argument('--latency', type=float, default=0.0, help="задержка ответа Telegram, сек")
+    parser.add_argument('--trace-memory', action='store_true', help="мерить пиковую память через tracemalloc (медленнее)")
+    parser.add_argument('--lines', type=int, default=1_000_000)
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--users', type=int, default=1_000_000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        logging.basicConfig(level=logging.WARNING)
+        for name, run in (('parse', bench_parse), ('convert', bench_convert), ('codec', bench_codec), ('bloom', bench_bloom)):
+            if args.bench in ('all', name):
+                # Каждый замер работает со своей базой в отдельном каталоге
+                os.makedirs(os.path.join(workdir, name))
+                os.chdir(os.path.join(workdir, name))
+                print(f"== {name}")
+                run(args)
+
+
+if __name__ == '__main__':
+    main()
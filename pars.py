@@ -1,9 +1,26 @@
 import os
 import json
 import time
-import io
+import csv
+import gzip
+import shutil
+import tempfile
 import asyncio
+import io
+import mmap
+import functools
+import threading
 import logging
+import sys
+import html
+import cProfile
+import pstats
+from array import array
+from bisect import bisect_left, bisect_right
+from itertools import chain
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
 from datetime import datetime, timedelta
 
 from aiogram import Bot, Dispatcher, types
@@ -12,13 +29,25 @@ from aiogram.dispatcher import FSMContext
 from aiogram.dispatcher.filters.state import State, StatesGroup
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 from aiogram.utils import executor
+from aiogram.utils.exceptions import RetryAfter, MessageNotModified, BadRequest
 from aiogram.contrib.fsm_storage.memory import MemoryStorage
+from aiohttp import web
 from pyrogram import Client
 from pyrogram.types import Message
 from pyrogram.errors import MsgIdInvalid, FloodWait, ChannelInvalid, ChatAdminRequired, UsernameNotOccupied
 
 from dotenv import load_dotenv
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import yappi
+except ImportError:
+    yappi = None
+
 load_dotenv()
 
 # Настройки
@@ -27,36 +56,340 @@ api_id = os.getenv('API_ID')
 api_hash = os.getenv('API_HASH')
 admin_id = os.getenv('ADMIN_ID')
 
-# Инициализация клиента Pyrogram
-app = Client("zakaz", api_id=api_id, api_hash=api_hash)
+# Аккаунты Pyrogram: zakaz.session и дополнительные сессии рядом с ним, например SESSION_NAMES=zakaz,acc2,acc3
+session_names = [name.strip() for name in os.getenv('SESSION_NAMES', 'zakaz').split(',') if name.strip()] or ['zakaz']
 
 # База данных пользователей
 full_base_file = 'full_base.json'
+full_base_index_file = 'full_base.idx'
+full_base_bloom_file = 'full_base.bloom'
 new_users_file = 'new_users.json'
 channels_file = 'channels.json'
 chats_file = 'chats.json'
 acs_users_file = 'acs_users.json'
 auto_parser_settings_file = 'auto_parser_settings.json'
+channels_state_file = 'channels_state.json'
+checkpoint_file = 'parse_checkpoint.json'
+images_dir = 'images'
+images_cache_file = 'images_cache.json'
+converted_full_base_file = 'converted_full_base.txt'
+converted_new_users_file = 'converted_new_users.txt'
+base_export_file = 'users.txt'
+snapshots_dir = 'newFILES'
+
+# Выгрузки базы: txt или csv, по желанию сжатые gzip
+export_format = os.getenv('EXPORT_FORMAT', 'txt')
+export_gzip = os.getenv('EXPORT_GZIP', '0') == '1'
+snapshot_gzip = os.getenv('SNAPSHOT_GZIP', '0') == '1'  # сжимать снимки новых пользователей в newFILES
+
+# Параллельный парсинг
+parser_workers = int(os.getenv('PARSER_WORKERS', 4))        # каналов одновременно
+replies_workers = int(os.getenv('REPLIES_WORKERS', 8))      # постов с комментариями одновременно
+history_prefetch = int(os.getenv('HISTORY_PREFETCH', 100))  # постов истории, загружаемых наперед для каждого канала
+reorder_window = int(os.getenv('REORDER_WINDOW', 100))      # постов канала, ждущих слияния в базу по порядку
+chat_workers = int(os.getenv('CHAT_WORKERS', 3))            # чатов одновременно
+health_check_interval = float(os.getenv('HEALTH_CHECK_INTERVAL', 300))  # секунд между проверками сессии
+thread_active_days = int(os.getenv('THREAD_ACTIVE_DAYS', 7))  # сколько дней пост считается живым
+
+# Контрольные точки длинного парсинга
+checkpoint_users = int(os.getenv('CHECKPOINT_USERS', 500))           # сохранять каждые N измененных пользователей
+checkpoint_interval = float(os.getenv('CHECKPOINT_INTERVAL', 60))    # или каждые N секунд
+
+# Дисковые операции выполняются в отдельном потоке, чтобы не останавливать цикл событий
+io_workers = int(os.getenv('IO_WORKERS', 1))                  # потоков ввода-вывода; 1 - операции идут строго по очереди
+loop_lag_threshold = float(os.getenv('LOOP_LAG_THRESHOLD', 0.5))  # сообщать о блокировке цикла дольше N секунд
+
+# Выгрузка больших баз в нескольких процессах
+bulk_workers = int(os.getenv('BULK_WORKERS', os.cpu_count() or 1))
+bulk_min_size = int(os.getenv('BULK_MIN_SIZE', 64 * 1024 * 1024))    # база от N байт выгружается пулом процессов
+bulk_chunk_size = int(os.getenv('BULK_CHUNK_SIZE', 4 * 1024 * 1024))  # размер куска журнала на один процесс
+
+# Метрики: Prometheus-эндпоинт /metrics (0 - выключен) и файл, который перезаписывается после каждого запуска
+metrics_port = int(os.getenv('METRICS_PORT', 0))
+metrics_file = os.getenv('METRICS_FILE', 'metrics.prom')
+
+# Профилирование запусков парсинга, включается админом из настроек
+profiling_enabled = os.getenv('PROFILING', '0') == '1'
+profiles_dir = 'profiles'
+profile_top = int(os.getenv('PROFILE_TOP', 20))   # строк в сводке профиля
+
+# Сообщения с прогрессом парсинга
+progress_interval = float(os.getenv('PROGRESS_INTERVAL', 5))  # не чаще одного редактирования за N секунд
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(
+        '{}="{}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"')) for key, value in labels
+    ) + '}'
+
+class Metrics:
+    # Счетчики, текущие значения и гистограммы задержек в текстовом формате Prometheus.
+    # Обновляются и из цикла событий, и из потока ввода-вывода
+    buckets = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.run_counters = {}
+        self.run_started = self.run_finished = time.monotonic()
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def add(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.gauges[key] = self.gauges.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            histogram[0][bisect_left(self.buckets, seconds)] += 1
+            histogram[1] += seconds
+
+    @contextmanager
+    def timer(self, name, **labels):
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(name, time.monotonic() - started, **labels)
+
+    def start_run(self):
+        with self.lock:
+            self.run_counters = dict(self.counters)
+        self.run_started = self.run_finished = time.monotonic()
+
+    def finish_run(self):
+        self.run_finished = time.monotonic()
+
+    def run_total(self, name):
+        # Сумма счетчика по всем меткам с начала последнего запуска
+        with self.lock:
+            return sum(
+                value - self.run_counters.get(key, 0) for key, value in self.counters.items() if key[0] == name
+            )
+
+    def render(self):
+        lines = []
+        with self.lock:
+            for kind, values in (('counter', self.counters), ('gauge', self.gauges)):
+                typed = set()
+                for (name, labels), value in sorted(values.items()):
+                    if name not in typed:
+                        typed.add(name)
+                        lines.append(f"# TYPE {name} {kind}")
+                    lines.append(f"{name}{format_labels(labels)} {value}")
+            typed = set()
+            for (name, labels), (counts, total) in sorted(self.histograms.items()):
+                if name not in typed:
+                    typed.add(name)
+                    lines.append(f"# TYPE {name} histogram")
+                cumulative = 0
+                for bound, count in zip(self.buckets + ('+Inf',), counts):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{format_labels(labels + (('le', bound),))} {cumulative}")
+                lines.append(f"{name}_sum{format_labels(labels)} {total:.6f}")
+                lines.append(f"{name}_count{format_labels(labels)} {cumulative}")
+        return '\n'.join(lines) + '\n'
+
+metrics = Metrics()
+
+async def start_metrics_server():
+    if not metrics_port:
+        return
+
+    async def handle_metrics(request):
+        return web.Response(text=metrics.render(), content_type='text/plain')
+
+    metrics_app = web.Application()
+    metrics_app.router.add_get('/metrics', handle_metrics)
+    runner = web.AppRunner(metrics_app)
+    await runner.setup()
+    await web.TCPSite(runner, '0.0.0.0', metrics_port).start()
+    logging.info(f"Метрики доступны на порту {metrics_port}: /metrics")
+
+def metrics_summary():
+    # Строки для итогового сообщения о запуске
+    elapsed = max(metrics.run_finished - metrics.run_started, 1)
+    found = metrics.run_total('parser_users_found_total')
+    return (
+        f"<b>Запросов к Telegram:</b> {metrics.run_total('parser_telegram_requests_total')}\n"
+        f"<b>Ожидание FLOOD_WAIT:</b> {metrics.run_total('parser_flood_wait_seconds_total')} сек\n"
+        f"<b>Скорость:</b> {found * 60 / elapsed:.0f} чел/мин\n"
+    )
+
+class RateLimiter:
+    # Token bucket на семейство методов Telegram, подстраивается под FLOOD_WAIT
+    def __init__(self, name, rate, max_rate, burst=1):
+        self.name = name
+        self.rate = rate
+        self.min_rate = rate / 16
+        self.max_rate = max_rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.blocked_until = 0
+        self.successes = 0
+        self.lock = None
+
+    async def acquire(self):
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                if self.blocked_until > now:
+                    await asyncio.sleep(self.blocked_until - now)
+                    continue
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def on_success(self):
+        # После серии удачных запросов понемногу разгоняемся обратно
+        self.successes += 1
+        if self.successes >= 20 and self.rate < self.max_rate:
+            self.successes = 0
+            self.rate = min(self.max_rate, self.rate * 1.25)
+
+    def on_flood_wait(self, seconds):
+        # Каждый FLOOD_WAIT вдвое снижает темп и блокирует всё семейство на время ожидания
+        self.successes = 0
+        self.tokens = 0
+        self.rate = max(self.min_rate, self.rate / 2)
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+        metrics.inc('parser_flood_waits_total', limiter=self.name)
+        metrics.inc('parser_flood_wait_seconds_total', seconds, limiter=self.name)
+        logging.warning(f"FLOOD_WAIT {seconds} сек для {self.name}. Новый темп: {self.rate:.2f} запр/сек")
+
+# Семейство: (начальный темп, максимальный темп, запас токенов)
+rate_limits = {
+    'history': (1.0, 5.0, 1),     # get_chat, get_chat_history, get_messages
+    'replies': (1.0, 5.0, 1),     # get_discussion_replies
+    'members': (0.5, 3.0, 1),     # get_chat_members
+    'bot': (10.0, 30.0, 5),       # bot.send_*/edit_*
+}
+limiters = {'bot': RateLimiter('bot', *rate_limits['bot'])}
+
+async def limited_call(limiter, func, *args, **kwargs):
+    method = getattr(func, '__name__', 'call')
+    while True:
+        await limiter.acquire()
+        metrics.inc('parser_telegram_requests_total', limiter=limiter.name, method=method)
+        try:
+            with metrics.timer('parser_telegram_request_seconds', limiter=limiter.name):
+                result = await func(*args, **kwargs)
+        except FloodWait as e:
+            limiter.on_flood_wait(e.value)
+            continue
+        limiter.on_success()
+        return result
+
+async def limited_iter(limiter, make_iter, page_size=100, total=None):
+    # make_iter(yielded, last) создает итератор, продолжающий после уже полученных элементов,
+    # так что после FLOOD_WAIT выгрузка возобновляется, а не бросается
+    yielded = 0
+    last = None
+    while total is None or yielded < total:
+        iterator = make_iter(yielded, last).__aiter__()
+        pulled = 0
+        try:
+            while True:
+                new_page = pulled % page_size == 0
+                if new_page:
+                    # Очередная страница - это запрос к Telegram, его и меряем
+                    await limiter.acquire()
+                    metrics.inc('parser_telegram_requests_total', limiter=limiter.name, method='page')
+                    started = time.monotonic()
+                try:
+                    item = await iterator.__anext__()
+                except StopAsyncIteration:
+                    limiter.on_success()
+                    return
+                if new_page:
+                    metrics.observe('parser_telegram_request_seconds', time.monotonic() - started, limiter=limiter.name)
+                pulled += 1
+                if pulled % page_size == 0:
+                    limiter.on_success()
+                yielded += 1
+                last = item
+                yield item
+        except FloodWait as e:
+            limiter.on_flood_wait(e.value)
+        finally:
+            await iterator.aclose()
+
+async def skip_items(iterator, count, limiter, page_size=100):
+    # Для методов без offset (в Pyrogram 2.0.106 это get_discussion_replies и get_chat_members):
+    # пропускаем уже обработанные элементы при возобновлении. Пропуск тоже перекачивает страницы,
+    # поэтому каждая следующая страница ждет лимитер, иначе сразу после FLOOD_WAIT уйдет пачка запросов
+    skipped = 0
+    async for item in iterator:
+        if skipped < count:
+            skipped += 1
+            if skipped % page_size == 0:
+                await limiter.acquire()
+                metrics.inc('parser_telegram_requests_total', limiter=limiter.name, method='skip')
+            continue
+        yield item
+
+class LimitedBot(Bot):
+    # Все вызовы Bot API проходят через общий лимитер и учитывают retry_after
+    async def request(self, method, data=None, files=None, **kwargs):
+        limiter = limiters['bot']
+        while True:
+            await limiter.acquire()
+            metrics.inc('parser_bot_requests_total', method=method)
+            try:
+                with metrics.timer('parser_bot_request_seconds', method=method):
+                    result = await super().request(method, data, files, **kwargs)
+            except RetryAfter as e:
+                limiter.on_flood_wait(e.timeout)
+                if files:
+                    # Файлы уже вычитаны, повторить отправку нельзя
+                    raise
+                continue
+            limiter.on_success()
+            return result
 
 # Инициализация бота и диспетчера
-bot = Bot(token=API_TOKEN)
+bot = LimitedBot(token=API_TOKEN)
 storage = MemoryStorage()
 dp = Dispatcher(bot, storage=storage)
 dp.middleware.setup(LoggingMiddleware())
 
 parsed_users_count = 0
+saved_requests_count = 0
 parsing_in_progress = False
 
-parsed_users_count_lock = asyncio.Lock()
-new_users_count_lock = asyncio.Lock()
 
 channels = {}
 chats = {}
-users = set()
+users = None
 new_users = set()
-info_users = {}
 acs_users = set()
 auto_parser_settings = {}
+channels_state = {}
+parsed_user_ids = set()
+chats_progress = {}
+checkpoint = {}
+image_file_ids = {}
 
 class Form(StatesGroup):
     addch = State()
@@ -69,50 +402,599 @@ class Form(StatesGroup):
     auto_parser = State()
     auto_parser_time = State()
 
-def load_users():
-    users = set()
-    try:
-        with open(full_base_file, 'r') as f:
+# Кодек строк базы: читаем через orjson, если он установлен (его JSONDecodeError - подкласс json.JSONDecodeError),
+# пишем всегда байт в байт как json.dumps, чтобы файлы не зависели от установленных пакетов
+json_loads = orjson.loads if orjson else json.loads
+encode_string = json.encoder.encode_basestring_ascii
+
+def encode_value(value):
+    if value is None:
+        return 'null'
+    if type(value) is int:
+        return str(value)
+    if type(value) is str:
+        return encode_string(value)
+    return json.dumps(value)
+
+def encode_record(fields):
+    # То же, что json.dumps(dict(fields)), но без словаря и настройки кодировщика на каждую строку
+    return '{' + ', '.join(f'"{key}": {encode_value(value)}' for key, value in fields) + '}'
+
+class OffsetIndex:
+    # Компактный индекс id -> смещение: два отсортированных массива int64 (16 байт на пользователя)
+    # и небольшой словарь новых id, который время от времени вливается в массивы
+    merge_threshold = 100000
+
+    def __init__(self, ids=None, offsets=None):
+        self.ids = ids if ids is not None else array('q')
+        self.offsets = offsets if offsets is not None else array('q')
+        self.recent = {}
+
+    def find(self, user_id):
+        i = bisect_left(self.ids, user_id)
+        if i < len(self.ids) and self.ids[i] == user_id:
+            return i
+        return -1
+
+    def get(self, user_id, default=None):
+        if user_id in self.recent:
+            return self.recent[user_id]
+        i = self.find(user_id)
+        return self.offsets[i] if i >= 0 else default
+
+    def __getitem__(self, user_id):
+        offset = self.get(user_id)
+        if offset is None:
+            raise KeyError(user_id)
+        return offset
+
+    def __setitem__(self, user_id, offset):
+        i = self.find(user_id)
+        if i >= 0:
+            self.offsets[i] = offset
+            return
+        self.recent[user_id] = offset
+        if len(self.recent) >= self.merge_threshold:
+            self.merge()
+
+    def __contains__(self, user_id):
+        return user_id in self.recent or self.find(user_id) >= 0
+
+    def __len__(self):
+        return len(self.ids) + len(self.recent)
+
+    def __iter__(self):
+        yield from self.ids
+        yield from list(self.recent)
+
+    def append(self, user_id, offset):
+        # Только для заполнения по возрастанию id (сжатие базы)
+        self.ids.append(user_id)
+        self.offsets.append(offset)
+
+    def merge(self):
+        if not self.recent:
+            return
+        recent = sorted(self.recent.items())
+        self.recent = {}
+        if not self.ids or recent[0][0] > self.ids[-1]:
+            self.ids.extend(user_id for user_id, _ in recent)
+            self.offsets.extend(offset for _, offset in recent)
+            return
+        ids, offsets = array('q'), array('q')
+        i = 0
+        for user_id, offset in recent:
+            j = bisect_left(self.ids, user_id, i)
+            ids.extend(self.ids[i:j])
+            offsets.extend(self.offsets[i:j])
+            ids.append(user_id)
+            offsets.append(offset)
+            i = j
+        ids.extend(self.ids[i:])
+        offsets.extend(self.offsets[i:])
+        self.ids, self.offsets = ids, offsets
+
+    def items(self):
+        self.merge()
+        return zip(self.ids, self.offsets)
+
+    def bucket_offsets(self, starts):
+        # Смещения актуальных записей, разложенные по кускам журнала (starts - начала кусков по возрастанию).
+        # Массивы int64 - 8 байт на пользователя; сортируется каждый кусок отдельно, когда до него дойдет очередь
+        buckets = [array('q') for _ in starts]
+        for offset in chain(self.offsets, self.recent.values()):
+            buckets[bisect_right(starts, offset) - 1].append(offset)
+        return buckets
+
+    def memory_usage(self):
+        return (
+            self.ids.buffer_info()[1] * self.ids.itemsize
+            + self.offsets.buffer_info()[1] * self.offsets.itemsize
+            + sys.getsizeof(self.recent) + len(self.recent) * 64
+        )
+
+class BloomFilter:
+    # Вероятностное множество id: "точно нет" или "возможно есть".
+    # 10 бит и 7 хешей на id дают около 1% ложных срабатываний
+    bits_per_item = 10
+    hashes_count = 7
+
+    def __init__(self, capacity, data=None):
+        self.capacity = max(capacity, 1)
+        self.bits = self.capacity * self.bits_per_item
+        self.data = data if data is not None else bytearray((self.bits + 7) // 8)
+
+    def positions(self, user_id):
+        # splitmix64 перемешивает идущие подряд id, две половины хеша дают k позиций двойным хешированием
+        z = (user_id + 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF
+        z = ((z ^ (z >> 30)) * 0xBF58476D1CE4E5B9) & 0xFFFFFFFFFFFFFFFF
+        z = ((z ^ (z >> 27)) * 0x94D049BB133111EB) & 0xFFFFFFFFFFFFFFFF
+        z ^= z >> 31
+        h1, h2 = z & 0xFFFFFFFF, (z >> 32) | 1
+        return [(h1 + i * h2) % self.bits for i in range(self.hashes_count)]
+
+    def add(self, user_id):
+        for position in self.positions(user_id):
+            self.data[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, user_id):
+        data = self.data
+        return all(data[position >> 3] >> (position & 7) & 1 for position in self.positions(user_id))
+
+class UserStore:
+    # full_base.json ведется как журнал: новые и измененные пользователи дописываются в конец,
+    # а индекс id -> смещение последней записи хранится рядом и при старте дочитывается только по хвосту
+    compact_ratio = 2
+    index_magic = 0x58444955    # 'UIDX', формат: заголовок, отсортированные id, смещения, дописанные пары
+    bloom_magic = 0x4d4f4c42    # 'BLOM', формат: заголовок, биты фильтра
+    bloom_min_capacity = 100000
+
+    def __init__(self, path, index_path, bloom_path=None):
+        self.path = path
+        self.index_path = index_path
+        # Фильтр Блума рядом с журналом: пока он отвечает "точно нет", индекс с диска не читается вовсе
+        self.bloom_path = bloom_path
+        self.bloom = None
+        self.index_loaded = True
+        self.indexed_count = 0
+        self.offsets = OffsetIndex()
+        self.cache = {}
+        self.dirty = set()
+        self.added = 0
+        self.records = 0
+        self.size = 0
+        self.indexed_size = 0
+        self.unindexed = []
+        self.appended_pairs = 0
+        self.view = None
+        # Снятые для записи пачки (номер, пользователи, сколько из них новых) пишутся строго по очереди.
+        # flushing - последние снятые данные пользователей, чьи смещения появятся после записи
+        self.batches = deque()
+        self.batch_seq = 0
+        self.detached_added = 0
+        self.flushing = {}
+        # Цикл событий читает и дополняет базу, пока поток ввода-вывода сохраняет ее на диск.
+        # lock держится только на время работы с состоянием в памяти. Запись на диск идет под write_lock:
+        # только под ним меняются индекс, размер журнала и фильтр, поэтому пишущий читает их без lock.
+        # Порядок захвата: write_lock, затем lock
+        self.lock = threading.RLock()
+        self.write_lock = threading.RLock()
+
+    def load(self):
+        with self.write_lock, self.lock:
+            self.offsets = OffsetIndex()
+            self.cache = {}
+            self.dirty = set()
+            self.batches = deque()
+            self.detached_added = 0
+            self.flushing = {}
+            self.added = 0
+            self.records = 0
+            self.size = 0
+            self.indexed_size = 0
+            self.unindexed = []
+            self.appended_pairs = 0
+            self.bloom = None
+            self.index_loaded = True
+            self.close()
+            if not os.path.exists(self.path):
+                logging.info("User database file not found. Starting with empty set.")
+                if self.bloom_path:
+                    self.bloom = BloomFilter(self.bloom_min_capacity)
+                return
+            if self.load_bloom():
+                logging.info(f"Фильтр базы: {len(self)} пользователей, индекс будет прочитан при первом совпадении")
+                return
+            self.index_loaded = False
+            self.ensure_index()
+            if self.bloom_path:
+                self.rebuild_bloom()
+
+    def ensure_index(self):
+        # Индекс id -> смещение читается при первой необходимости: возможном совпадении, записи или выгрузке
+        if self.index_loaded:
+            return
+        with self.lock:
+            if self.index_loaded:
+                return
+            # Размеры из заголовка фильтра сбрасываем: если индекс не прочитается, журнал сканируется с начала
+            self.size = self.records = self.indexed_size = 0
+            self.load_index()
+            self.scan_tail()
+            self.offsets.merge()
+            self.index_loaded = True
+            if len(self):
+                logging.info(
+                    f"Индекс базы: {len(self)} пользователей, "
+                    f"{self.offsets.memory_usage() / len(self):.1f} байт на пользователя"
+                )
+
+    def load_bloom(self):
+        # Фильтр годится, только если покрывает журнал целиком; иначе индекс читается сразу, а фильтр перестраивается
+        if not self.bloom_path:
+            return False
+        try:
+            with open(self.bloom_path, 'rb') as f:
+                header = array('q')
+                header.fromfile(f, 5)
+                magic, covered_size, records, count, capacity = header
+                data = bytearray(f.read())
+        except (FileNotFoundError, EOFError, ValueError):
+            return False
+        bloom = BloomFilter(capacity, data)
+        if magic != self.bloom_magic or covered_size != os.path.getsize(self.path) or len(data) != (bloom.bits + 7) // 8:
+            logging.warning("Фильтр базы не соответствует файлу, перестраиваем.")
+            return False
+        self.bloom = bloom
+        self.size = covered_size
+        self.records = records
+        self.indexed_count = count
+        self.index_loaded = False
+        return True
+
+    def rebuild_bloom(self):
+        # Новый фильтр заполняется в стороне: цикл событий все это время проверяет старый
+        bloom = BloomFilter(max(self.bloom_min_capacity, len(self.offsets) * 2))
+        for user_id in self.offsets:
+            bloom.add(user_id)
+        self.bloom = bloom
+        self.save_bloom()
+
+    def save_bloom(self):
+        if not self.bloom_path or self.bloom is None:
+            return
+        if len(self.offsets) > self.bloom.capacity:
+            # Фильтр переполнен и начнет часто ошибаться: строим вдвое больший
+            self.rebuild_bloom()
+            return
+        tmp_path = self.bloom_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            array('q', (self.bloom_magic, self.size, self.records, len(self.offsets), self.bloom.capacity)).tofile(f)
+            f.write(self.bloom.data)
+        os.replace(tmp_path, self.bloom_path)
+
+    def load_index(self):
+        try:
+            file_size = os.path.getsize(self.path)
+            with open(self.index_path, 'rb') as f:
+                header = array('q')
+                header.fromfile(f, 4)
+                magic, indexed_size, records, count = header
+                if magic != self.index_magic or indexed_size > file_size:
+                    logging.warning("Индекс базы не соответствует файлу, перестраиваем.")
+                    return
+                ids, offsets = array('q'), array('q')
+                ids.fromfile(f, count)
+                offsets.fromfile(f, count)
+                pairs = array('q', f.read())
+        except (FileNotFoundError, EOFError, ValueError):
+            return
+        self.offsets = OffsetIndex(ids, offsets)
+        for i in range(0, len(pairs) - 1, 2):
+            if pairs[i + 1] < indexed_size:
+                self.offsets[pairs[i]] = pairs[i + 1]
+        self.appended_pairs = len(pairs) // 2
+        self.records = records
+        self.size = self.indexed_size = indexed_size
+
+    def scan_tail(self):
+        # Дочитываем записи, которые были дописаны после последнего сохранения индекса
+        with open(self.path, 'rb+') as f:
+            f.seek(self.size)
+            offset = self.size
             for line in f:
+                if not line.endswith(b'\n'):
+                    # Недописанная строка после аварийной остановки
+                    f.truncate(offset)
+                    logging.warning(f"Обрезана недописанная запись в конце {self.path}")
+                    break
                 try:
-                    user_data = json.loads(line)
-                    user_id = user_data['user_id']
-                    users.add(user_id)
-                    info_users[user_id] = {
-                        'username': user_data.get('username'),
-                        'phone': user_data.get('phone')
-                    }
-                except json.JSONDecodeError:
+                    user_id = json_loads(line)['user_id']
+                    self.offsets[user_id] = offset
+                    self.unindexed.append(user_id)
+                    self.records += 1
+                except (json.JSONDecodeError, KeyError):
                     logging.warning(f"Skipping invalid JSON line: {line}")
-    except FileNotFoundError:
-        logging.info("User database file not found. Starting with empty set.")
+                offset += len(line)
+            self.size = offset
+
+    def close(self):
+        if self.view is not None:
+            self.view.close()
+            self.view = None
+
+    def read_record(self, offset):
+        # Журнал отображен в память: запись - срез до конца строки, без seek и буфера чтения.
+        # Дописанные после отображения записи лежат за его концом, тогда отображаем файл заново
+        if self.view is None or offset >= len(self.view):
+            self.close()
+            self.view = map_file(self.path)
+        return json_loads(self.view[offset:self.view.find(b'\n', offset)])
+
+    def indexed(self, user_id):
+        # Фильтр отсекает точно новых пользователей без обращения к индексу
+        if self.bloom is not None and user_id not in self.bloom:
+            return False
+        self.ensure_index()
+        return user_id in self.offsets
+
+    def __contains__(self, user_id):
+        with self.lock:
+            return user_id in self.dirty or user_id in self.flushing or self.indexed(user_id)
+
+    def __len__(self):
+        return (len(self.offsets) if self.index_loaded else self.indexed_count) + self.added
+
+    def __iter__(self):
+        self.ensure_index()
+        yield from self.offsets
+        for user_id in chain(self.flushing, self.dirty):
+            if user_id not in self.offsets:
+                yield user_id
+
+    def get(self, user_id):
+        with self.lock:
+            if user_id in self.cache:
+                return self.cache[user_id]
+            if user_id in self.flushing:
+                return dict(self.flushing[user_id])
+            if self.indexed(user_id):
+                record = self.read_record(self.offsets[user_id])
+                return {key: record[key] for key in ('username', 'phone') if key in record}
+            return {}
+
+    def add(self, user_id):
+        self.update(user_id, None, None)
+
+    def update(self, user_id, username, phone):
+        with self.lock:
+            info = self.cache.get(user_id)
+            if info is None:
+                if user_id not in self.flushing and not self.indexed(user_id):
+                    self.added += 1
+                    self.dirty.add(user_id)
+                info = self.cache[user_id] = self.get(user_id)
+            if username and username != 'Not available' and info.get('username') != username:
+                info['username'] = username
+                self.dirty.add(user_id)
+            if phone and phone != 'Not available' and info.get('phone') != phone:
+                info['phone'] = phone
+                self.dirty.add(user_id)
+
+    def encode(self, user_id, info):
+        fields = [("user_id", user_id)]
+        for key in ('username', 'phone'):
+            if info.get(key) is not None:
+                fields.append((key, info[key]))
+        return (encode_record(fields) + '\n').encode()
+
+    def detach(self):
+        # Снимает измененных пользователей в пачку на запись и возвращает ее номер. Вызывается в цикле событий
+        # вместе со снимком состояния, которому пачка должна соответствовать: все, что изменится позже,
+        # уйдет следующей пачкой
+        with self.lock:
+            if self.dirty:
+                entries = {user_id: self.cache[user_id] for user_id in self.dirty}
+                added = self.added - self.detached_added
+                self.batch_seq += 1
+                self.batches.append((self.batch_seq, entries, added))
+                self.flushing.update(entries)
+                self.detached_added += added
+                self.dirty = set()
+            self.cache = {}
+            return self.batch_seq
+
+    def flush(self, upto=None):
+        # Дописываем только новых и измененных пользователей: пачки до upto включительно, по умолчанию все.
+        # Под lock пачки только снимаются и публикуются, так что цикл событий продолжает добавлять
+        # пользователей, пока строки пишутся и синхронизируются
+        with self.write_lock, metrics.timer('parser_storage_seconds', op='flush'):
+            if upto is None:
+                upto = self.detach()
+            while True:
+                with self.lock:
+                    if not self.batches or self.batches[0][0] > upto:
+                        return
+                    batch = self.batches.popleft()
+                self.write_batch(*batch)
+
+    def write_batch(self, seq, entries, added):
+        self.ensure_index()
+        written = []
+        try:
+            with open(self.path, 'ab') as f:
+                offset = f.tell()
+                for user_id, info in entries.items():
+                    line = self.encode(user_id, info)
+                    f.write(line)
+                    written.append((user_id, offset))
+                    offset += len(line)
+                f.flush()
+                os.fsync(f.fileno())
+        except BaseException:
+            with self.lock:
+                # Не записалось: возвращаем пользователей в очередь, если их уже не сняла более свежая пачка
+                for user_id, info in entries.items():
+                    if self.flushing.get(user_id) is info:
+                        del self.flushing[user_id]
+                        self.cache.setdefault(user_id, info)
+                        self.dirty.add(user_id)
+                self.detached_added -= added
+            raise
+        with self.lock:
+            for user_id, line_offset in written:
+                self.offsets[user_id] = line_offset
+                if self.bloom is not None:
+                    self.bloom.add(user_id)
+                if self.flushing.get(user_id) is entries[user_id]:
+                    del self.flushing[user_id]
+            self.unindexed.extend(user_id for user_id, _ in written)
+            self.records += len(written)
+            self.size = offset
+            self.added -= added
+            self.detached_added -= added
+
+    def save_index(self):
+        # Индекс тоже только дописывается: пары (id, смещение), заголовок с размером покрытого журнала
+        with self.write_lock:
+            self.ensure_index()
+            if not os.path.exists(self.index_path) or self.indexed_size == 0 or self.appended_pairs > len(self) // 2:
+                self.write_full_index()
+                return
+            pairs = array('q')
+            for user_id in self.unindexed:
+                pairs.extend((user_id, self.offsets[user_id]))
+            with open(self.index_path, 'rb+') as f:
+                f.seek(0, os.SEEK_END)
+                pairs.tofile(f)
+                f.seek(8)
+                array('q', (self.size, self.records)).tofile(f)
+            self.appended_pairs += len(pairs) // 2
+            self.unindexed = []
+            self.indexed_size = self.size
+            self.save_bloom()
+
+    def write_full_index(self):
+        with self.write_lock:
+            with self.lock:
+                self.offsets.merge()
+            tmp_path = self.index_path + '.tmp'
+            with open(tmp_path, 'wb') as f:
+                array('q', (self.index_magic, self.size, self.records, len(self.offsets.ids))).tofile(f)
+                self.offsets.ids.tofile(f)
+                self.offsets.offsets.tofile(f)
+            os.replace(tmp_path, self.index_path)
+            self.appended_pairs = 0
+            self.unindexed = []
+            self.indexed_size = self.size
+            self.save_bloom()
+
+    def compact(self):
+        # Переписываем журнал, оставляя по одной актуальной записи на пользователя.
+        # Пока пишется новый файл, цикл событий читает старый; подмена файла и индекса идет под lock
+        with self.write_lock:
+            self.ensure_index()
+            self.flush()
+            with self.lock:
+                self.offsets.merge()
+            tmp_path = self.path + '.tmp'
+            offsets = OffsetIndex()
+            with open(self.path, 'rb') as src, open(tmp_path, 'wb') as dst:
+                for user_id, offset in zip(self.offsets.ids, self.offsets.offsets):
+                    src.seek(offset)
+                    offsets.append(user_id, dst.tell())
+                    dst.write(src.readline())
+                dst.flush()
+                os.fsync(dst.fileno())
+            # Старые индекс и фильтр описывают старый журнал: убираем их до подмены, чтобы при сбое
+            # до записи нового индекса база при старте перечитывалась целиком, а не по чужим смещениям
+            for path in (self.index_path, self.bloom_path):
+                if path and os.path.exists(path):
+                    os.remove(path)
+            with self.lock:
+                self.close()
+                os.replace(tmp_path, self.path)
+                self.offsets = offsets
+                self.records = len(offsets)
+                self.size = os.path.getsize(self.path)
+            self.write_full_index()
+            logging.info(f"База пользователей сжата до {self.records} записей")
+
+    def iter_chunks(self):
+        # Куски журнала с отсортированными смещениями актуальных записей. Вызывается под write_lock:
+        # пока идет выгрузка, журнал не дописывается и не сжимается, а цикл событий работает как обычно
+        self.ensure_index()
+        chunks = split_chunks(self.path, self.size, bulk_chunk_size)
+        buckets = self.offsets.bucket_offsets([start for start, _ in chunks])
+        for (start, end), bucket in zip(chunks, buckets):
+            yield start, end, array('q', sorted(bucket))
+
+    def iter_records(self):
+        # Чтение актуальных записей в порядке файла: устаревшие версии даже не разбираются
+        with self.write_lock:
+            self.ensure_index()
+            if self.size == 0:
+                return
+            with map_file(self.path) as view:
+                for _, _, offsets in self.iter_chunks():
+                    for offset in offsets:
+                        yield json_loads(view[offset:view.find(b'\n', offset)])
+
+    def iter_export_blocks(self, separator=' ', require_username=False, ids=None, export_format='txt'):
+        # То же, что export_users(iter_records()), но куски журнала разбираются в пуле процессов.
+        # Каждый процесс получает смещения актуальных записей своего куска, устаревшие версии он даже не разбирает.
+        # В работе одновременно не больше двух кусков на процесс, результаты отдаются в порядке файла
+        with self.write_lock, ProcessPoolExecutor(max_workers=bulk_workers) as pool:
+            chunks = self.iter_chunks()
+            futures = deque()
+            while True:
+                while len(futures) < bulk_workers * 2:
+                    chunk = next(chunks, None)
+                    if chunk is None:
+                        break
+                    futures.append(pool.submit(
+                        convert_chunk, self.path, chunk[2], separator, require_username, ids, export_format
+                    ))
+                if not futures:
+                    return
+                yield futures.popleft().result()
+
+    def save(self):
+        with self.write_lock, metrics.timer('parser_storage_seconds', op='save'):
+            self.ensure_index()
+            self.flush()
+            if self.records > len(self.offsets) * self.compact_ratio:
+                self.compact()
+            else:
+                self.save_index()
+
+    def delete(self):
+        with self.write_lock, self.lock:
+            self.close()
+            for path in (self.path, self.index_path, self.bloom_path):
+                if path and os.path.exists(path):
+                    os.remove(path)
+            self.load()
+
+def load_users():
+    users = UserStore(full_base_file, full_base_index_file, full_base_bloom_file)
+    users.load()
     return users
 
 def save_users(users):
-    with open(full_base_file, 'w') as f:
-        for user_id in users:
-            user_info = info_users.get(user_id, {})
-            user_data = {
-                "user_id": user_id,
-                "username": user_info.get('username'),
-                "phone": user_info.get('phone')
-            }
-            f.write(json.dumps({k: v for k, v in user_data.items() if v is not None and v != 'Not available'}) + '\n')
+    users.save()
 
 def update_user_info(user_id, username, phone):
-    if user_id not in info_users:
-        info_users[user_id] = {}
-    
-    if username and username != 'Not available':
-        info_users[user_id]['username'] = username
-    if phone and phone != 'Not available':
-        info_users[user_id]['phone'] = phone
+    users.update(user_id, username, phone)
 
 def save_new_users(new_users):
-    with open(new_users_file, 'w') as f:
+    # Новый файл подменяет старый целиком: снимки в newFILES могут быть жесткими ссылками на прежнюю версию
+    tmp_path = new_users_file + '.tmp'
+    with open(tmp_path, 'w') as f:
         for user_id in new_users:
-            user_info = info_users.get(user_id, {})
-            f.write(json.dumps({"user_id": user_id, "username": user_info.get('username', None), "phone": user_info.get('phone', None)}) + '\n')
+            user_info = users.get(user_id)
+            f.write(encode_record((("user_id", user_id), ("username", user_info.get('username')), ("phone", user_info.get('phone')))) + '\n')
+    os.replace(tmp_path, new_users_file)
 
 def load_acs_users():
     try:
@@ -136,6 +1018,58 @@ def save_channels(channels):
     with open(channels_file, 'w') as f:
         json.dump(channels, f)
 
+def save_json_atomic(path, data):
+    save_text_atomic(path, json.dumps(data))
+
+def save_text_atomic(path, text):
+    # Запись во временный файл и переименование: после падения останется либо старая, либо новая версия
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+io_executor = ThreadPoolExecutor(max_workers=io_workers, thread_name_prefix='io')
+
+async def run_io(func, *args, **kwargs):
+    # Блокирующая работа с файлами уходит в поток ввода-вывода
+    return await asyncio.get_running_loop().run_in_executor(io_executor, functools.partial(func, *args, **kwargs))
+
+async def monitor_loop_lag(interval=1.0):
+    # Если таймер сработал заметно позже, значит какой-то обработчик занял цикл событий
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(interval)
+        lag = loop.time() - started - interval
+        if lag > loop_lag_threshold:
+            logging.warning(f"Цикл событий был заблокирован на {lag:.2f} сек")
+
+def load_channels_state():
+    try:
+        with open(channels_state_file, 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+def save_channels_state(state):
+    save_json_atomic(channels_state_file, state)
+
+def load_checkpoint():
+    try:
+        with open(checkpoint_file, 'r') as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+def save_checkpoint(checkpoint):
+    save_json_atomic(checkpoint_file, checkpoint)
+
+def clear_checkpoint():
+    if os.path.exists(checkpoint_file):
+        os.remove(checkpoint_file)
+
 def load_chats():
     try:
         with open(chats_file, 'r') as f:
@@ -158,8 +1092,157 @@ def save_auto_parser_settings(settings):
     with open(auto_parser_settings_file, 'w') as f:
         json.dump(settings, f)
 
+def load_image_file_ids():
+    try:
+        with open(images_cache_file, 'r') as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+def save_image_file_ids(file_ids):
+    save_json_atomic(images_cache_file, file_ids)
+
+async def send_image(chat_id, name, **kwargs):
+    # Картинка загружается в Telegram один раз, дальше отправляется по сохраненному file_id.
+    # Замененный файл (другой размер или время изменения) загружается заново
+    path = os.path.join(images_dir, name)
+    stat = os.stat(path)
+    version = [stat.st_size, int(stat.st_mtime)]
+    cached = image_file_ids.get(name)
+    if cached and cached['version'] == version:
+        try:
+            return await bot.send_photo(chat_id, cached['file_id'], **kwargs)
+        except BadRequest as e:
+            if 'file' not in str(e).lower():
+                raise
+            logging.warning(f"Telegram отклонил file_id картинки {name}, загружаем заново: {str(e)}")
+
+    with open(path, 'rb') as photo:
+        message = await bot.send_photo(chat_id, photo, **kwargs)
+    image_file_ids[name] = {'file_id': message.photo[-1].file_id, 'version': version}
+    save_image_file_ids(image_file_ids)
+    return message
+
+class ClientManager:
+    # Клиент Pyrogram подключается один раз при старте бота и переиспользуется всеми запусками парсинга
+    def __init__(self, client, health_interval, limiter):
+        self.client = client
+        self.health_interval = health_interval
+        self.limiter = limiter
+        self.lock = None
+
+    async def start(self):
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+        async with self.lock:
+            if not self.client.is_connected:
+                await self.client.start()
+                logging.info("Клиент Pyrogram подключен")
+
+    async def get(self):
+        await self.start()
+        return self.client
+
+    async def reconnect(self):
+        async with self.lock:
+            logging.warning("Переподключение клиента Pyrogram...")
+            try:
+                if self.client.is_connected:
+                    await self.client.stop()
+            except Exception as e:
+                logging.warning(f"Ошибка при остановке клиента: {str(e)}")
+            await self.client.start()
+            logging.info("Клиент Pyrogram переподключен")
+
+    async def stop(self):
+        if self.client.is_connected:
+            await self.client.stop()
+
+    async def health_check(self):
+        failures = 0
+        while True:
+            # После неудачного переподключения повторяем чаще: 10, 20, 40... секунд
+            await asyncio.sleep(min(10 * 2 ** failures, self.health_interval) if failures else self.health_interval)
+            try:
+                await self.start()
+                await limited_call(self.limiter, self.client.get_me)
+                failures = 0
+            except Exception as e:
+                logging.warning(f"Проверка сессии Pyrogram не прошла: {str(e)}")
+                try:
+                    await self.reconnect()
+                    failures = 0
+                except Exception as e:
+                    failures += 1
+                    logging.error(f"Не удалось переподключить клиент Pyrogram: {str(e)}")
+
+class Account:
+    # Аккаунт из пула: свой клиент, свои лимиты и свое состояние FLOOD_WAIT
+    def __init__(self, name):
+        self.name = name
+        # sleep_threshold=0: любой FLOOD_WAIT доходит до наших лимитеров, а не проглатывается внутри Pyrogram
+        self.client = Client(name, api_id=api_id, api_hash=api_hash, sleep_threshold=0)
+        self.limiters = {
+            family: RateLimiter(f"{name}/{family}", *rate_limits[family])
+            for family in ('history', 'replies', 'members')
+        }
+        self.manager = ClientManager(self.client, health_check_interval, self.limiters['history'])
+        self.active = 0
+
+class SessionPool:
+    # Раздает каналы и чаты по аккаунтам; работа уходит тому, кто сейчас не в FLOOD_WAIT и меньше загружен
+    def __init__(self, names):
+        self.accounts = [Account(name) for name in names]
+
+    async def start(self):
+        for account in self.accounts:
+            try:
+                await account.manager.start()
+            except Exception as e:
+                logging.error(f"Не удалось подключить аккаунт {account.name}: {str(e)}")
+
+    async def stop(self):
+        for account in self.accounts:
+            await account.manager.stop()
+
+    def start_health_checks(self):
+        for account in self.accounts:
+            asyncio.create_task(account.manager.health_check())
+
+    def candidates(self, family):
+        now = time.monotonic()
+        return sorted(self.accounts, key=lambda account: (
+            max(account.limiters[family].blocked_until - now, 0),
+            account.active,
+            -account.limiters[family].rate
+        ))
+
+    @asynccontextmanager
+    async def lease(self, family):
+        # Аккаунт, который не удалось подключить, пропускаем и отдаем работу следующему
+        error = None
+        for account in self.candidates(family):
+            account.active += 1
+            try:
+                await account.manager.get()
+            except Exception as e:
+                account.active -= 1
+                error = e
+                logging.warning(f"Аккаунт {account.name} недоступен: {str(e)}")
+                continue
+            try:
+                yield account
+            finally:
+                account.active -= 1
+            return
+        raise error
+
+session_pool = SessionPool(session_names)
+# Основной аккаунт: на нем же работает обработчик входящих сообщений
+app = session_pool.accounts[0].client
+
 @app.on_message()
-def handle_message(client, message: Message):
+async def handle_message(client, message: Message):
     global new_users_count
     if message.from_user:
         user_id = message.from_user.id
@@ -170,89 +1253,351 @@ def handle_message(client, message: Message):
             update_user_info(user_id, message.from_user.username, message.from_user.phone_number)
             logging.info(f"Новый юзер аддед: {user_id}")
 
-async def parse_channels(limit=50):
+def post_has_comments(message):
+    # Решаем по данным из истории, без отдельного get_messages на каждый пост
+    if message.empty or message.service:
+        logging.warning(f"Сообщение {message.id} не существует. Пропуск.")
+        return False
+    # В закрепленном Pyrogram 2.0.106 у Message нет счетчика комментариев, поэтому сейчас экономится
+    # только get_messages, а за комментариями идем для каждого поста. Счетчик учитывается, если появится
+    replies = getattr(message, 'replies', None)
+    if replies is not None and not replies:
+        return False
+    return True
+
+def register_parsed_user(user):
+    # Дедупликация за запуск по id: O(1) на каждый комментарий/участника, логин и телефон дописываются
     global parsed_users_count, new_users_count
-    async with app:
-        for channel_username in channels.keys():
+    is_new = user.id not in users
+    update_user_info(user.id, user.username, user.phone_number)
+    if user.id in parsed_user_ids:
+        return False
+    parsed_user_ids.add(user.id)
+    parsed_users_count += 1
+    if is_new:
+        new_users.add(user.id)
+        new_users_count += 1
+        logging.info(f"Добавлен пользователь: {user.id}")
+    return True
+
+async def parse_post(account, channel, message, replies_semaphore, threads, incremental):
+    # Возвращает авторов комментариев и id самого нового ответа. В базу авторов и отметку обсуждения
+    # заносит parse_channel в порядке постов, чтобы контрольная точка не опережала сохраненных пользователей.
+    # Если комментарии дочитаны не до конца, вместо id возвращается None: отметка не ставится
+    global saved_requests_count
+    authors = []
+    max_reply_id = 0
+    # Комментарии идут от новых к старым, поэтому на уже виденном ответе можно остановиться
+    last_reply_id = threads.get(str(message.id), 0) if incremental else 0
+    try:
+        if not parsing_in_progress:
+            # Пост не обработан: курсор контрольной точки на нем остановится
+            return None
+        # Отдельный get_messages больше не нужен: пост уже пришел из истории
+        saved_requests_count += 1
+        if not post_has_comments(message):
+            saved_requests_count += 1
+            return authors, max_reply_id
+
+        replies = limited_iter(
+            account.limiters['replies'],
+            lambda yielded, last: skip_items(
+                account.client.get_discussion_replies(channel.id, message.id), yielded, account.limiters['replies']
+            )
+        )
+        async for reply in replies:
+            if reply.id <= last_reply_id:
+                break
+            max_reply_id = max(max_reply_id, reply.id)
+            if reply.from_user:
+                authors.append(reply.from_user)
+
+        logging.info(f"Обработано сообщение {message.id}")
+
+    except MsgIdInvalid:
+        logging.warning(f"Недействительный ID сообщения {message.id}. Пропуск.")
+    except Exception as e:
+        logging.warning(f"Ошибка при обработке сообщения {message.id}: {str(e)}")
+        # Ответы идут от новых к старым: отметка по прочитанной части скрыла бы непрочитанные старые
+        max_reply_id = None
+    finally:
+        replies_semaphore.release()
+        metrics.add('parser_replies_in_flight', -1)
+    return authors, max_reply_id
+
+async def parse_channel(account, channel_username, limit, replies_semaphore, incremental):
+    pending = deque()
+    found = 0
+    state = channels_state.setdefault(channel_username, {'last_message_id': 0, 'threads': {}})
+    threads = state['threads']
+    last_message_id = state['last_message_id']
+    # При продолжении с контрольной точки начинаем с последнего полностью обработанного поста
+    cursor = checkpoint['cursors'].get(channel_username, {})
+    offset_id = cursor.get('offset_id', 0)
+    processed = cursor.get('processed', 0)
+    newest_message_id = max(last_message_id, cursor.get('newest', 0))
+    oldest_message_id = offset_id
+    active_since = datetime.now() - timedelta(days=thread_active_days)
+    history_queue = asyncio.Queue(maxsize=history_prefetch)
+    history_done = False
+    producer = None
+    completed = False
+    failed = False
+    started = time.monotonic()
+
+    def advance_cursor():
+        nonlocal found, processed, failed
+        # Курсор двигается только по непрерывному префиксу завершенных постов,
+        # в том же порядке авторы комментариев попадают в базу
+        while pending and pending[0][1].done() and pending[0][1].result() is not None:
+            message_id, task = pending.popleft()
+            authors, max_reply_id = task.result()
+            for user in authors:
+                if register_parsed_user(user):
+                    found += 1
+            if max_reply_id is None:
+                # Пост дочитан с ошибкой: дальше курсор не двигается, канал не считается пройденным,
+                # и следующий запуск перечитает пост целиком. Посты после него сливаются как обычно
+                failed = True
+            elif max_reply_id:
+                thread_key = str(message_id)
+                threads[thread_key] = max(threads.get(thread_key, 0), max_reply_id)
+            if failed:
+                continue
+            processed += 1
+            checkpoint['cursors'][channel_username] = {
+                'offset_id': message_id,
+                'processed': processed,
+                'newest': newest_message_id
+            }
+
+    async def fetch_history(channel):
+        # История листается наперед в ограниченную очередь, пока комментарии прошлых постов еще выгружаются
+        nonlocal history_done
+        try:
+            # processed растет по ходу выгрузки, поэтому остаток окна считаем один раз
+            remaining = limit - processed if limit else None
+            history = limited_iter(
+                account.limiters['history'],
+                lambda yielded, last: account.client.get_chat_history(
+                    channel.id,
+                    limit=remaining - yielded if limit else 0,
+                    offset_id=last.id if last else offset_id
+                ),
+                total=remaining
+            )
+            async for message in history:
+                if not parsing_in_progress:
+                    break
+                # Старые посты, обработанные в прошлые запуски и уже без обсуждения, больше не перечитываем
+                if incremental and message.id <= last_message_id and message.date and message.date < active_since:
+                    break
+                await history_queue.put(message)
+            history_done = parsing_in_progress
+        except Exception as e:
+            logging.error(f"Ошибка при чтении истории {channel_username}: {str(e)}")
+        await history_queue.put(None)
+
+    try:
+        channel = await limited_call(account.limiters['history'], account.client.get_chat, channel_username)
+        producer = asyncio.create_task(fetch_history(channel))
+
+        while parsing_in_progress:
+            message = await history_queue.get()
+            if message is None:
+                break
+            # Пока первый пост окна не готов, новые не берем: буфер слияния и история не растут без предела
+            while len(pending) >= reorder_window and parsing_in_progress:
+                await asyncio.wait([pending[0][1]])
+                advance_cursor()
             if not parsing_in_progress:
                 break
-            users_data = []
+            newest_message_id = max(newest_message_id, message.id)
+            oldest_message_id = message.id
+            # Семафор берется до создания задачи: когда лимитер комментариев не успевает, слоты заняты и история ждет
+            await replies_semaphore.acquire()
+            metrics.add('parser_replies_in_flight', 1)
+            pending.append((message.id, asyncio.create_task(
+                parse_post(account, channel, message, replies_semaphore, threads, incremental)
+            )))
+            advance_cursor()
+        completed = history_done and parsing_in_progress
 
-            try:
-                channel = await app.get_chat(channel_username)
-                
-                async for message in app.get_chat_history(channel.id, limit=limit):
-                    if not parsing_in_progress:
-                        break
-                    try:
-                        if not await app.get_messages(channel.id, message.id):
-                            logging.warning(f"Сообщение {message.id} не существует. Пропуск.")
-                            continue
-
-                        async for reply in app.get_discussion_replies(channel.id, message.id):
-                            if reply.from_user:
-                                user = reply.from_user
-                                user_data = {
-                                    'id': user.id,
-                                    'username': user.username if user.username else 'Not available',
-                                    'phone': user.phone_number if user.phone_number else 'Not available'
-                                }
-                                if user_data not in users_data:
-                                    users_data.append(user_data)
-                                    async with parsed_users_count_lock:
-                                        parsed_users_count += 1
-                                    if user_data['id'] not in users:
-                                        async with new_users_count_lock:
-                                            new_users.add(user_data['id'])
-                                            new_users_count += 1
-                                        logging.info(f"Добавлен пользователь: {user_data['id']}")
-                        
-                        logging.info(f"Обработано сообщение {message.id}")
-                    
-                    except Exception as e:
-                        if "FLOOD_WAIT" in str(e):
-                            wait_time = int(str(e).split()[-2])
-                            logging.warning(f"Достигнут лимит запросов. Ожидание {wait_time} секунд.")
-                            await asyncio.sleep(wait_time)
-                        elif "MSG_ID_INVALID" in str(e):
-                            logging.warning(f"Недействительный ID сообщения {message.id}. Пропуск.")
-                        else:
-                            logging.warning(f"Ошибка при обработке сообщения {message.id}: {str(e)}")
-                        continue
-
-                    await asyncio.sleep(2)
-
-                if users_data:
-                    for user_data in users_data:
-                        user_id = user_data['id']
-                        users.add(user_id)
-                        if user_id not in info_users:
-                            new_users.add(user_id)
-                        update_user_info(user_id, user_data['username'], user_data['phone'])    
-                    logging.info(f"Данные {len(users_data)} пользователей сохранены в базу")
-                else:
-                    logging.info(f"В канале {channel_username} не найдено комментариев с данными пользователей.")
+    except Exception as e:
+        logging.error(f"Произошла ошибка: {str(e)}")
+    finally:
+        if producer:
+            producer.cancel()
+            await asyncio.gather(producer, return_exceptions=True)
+        await asyncio.gather(*[task for _, task in pending])
+        advance_cursor()
+
+    if completed and not failed and parsing_in_progress:
+        # Отметку сдвигаем только если канал пройден до конца окна, иначе при остановке потеряем посты
+        state['last_message_id'] = newest_message_id
+        state['threads'] = {key: value for key, value in threads.items() if int(key) >= oldest_message_id}
+        checkpoint['cursors'].pop(channel_username, None)
+        checkpoint['done_channels'].append(channel_username)
+
+    metrics.inc('parser_users_found_total', found, source=channel_username)
+    metrics.set('parser_channel_users_per_minute', round(found * 60 / max(time.monotonic() - started, 1), 1), channel=channel_username)
+
+    if found:
+        logging.info(f"Данные {found} пользователей сохранены в базу")
+    else:
+        logging.info(f"В канале {channel_username} не найдено комментариев с данными пользователей.")
 
+async def channel_worker(queue, limit, replies_semaphore, incremental):
+    while parsing_in_progress:
+        try:
+            channel_username = queue.get_nowait()
+        except asyncio.QueueEmpty:
+            return
+        metrics.set('parser_channels_queue_depth', queue.qsize())
+        async with session_pool.lease('replies') as account:
+            await parse_channel(account, channel_username, limit, replies_semaphore, incremental)
+
+async def parse_channels(limit=50, incremental=True):
+    global saved_requests_count
+    saved_requests_count = 0
+    queue = asyncio.Queue()
+    for channel_username in channels.keys():
+        if channel_username not in checkpoint['done_channels']:
+            queue.put_nowait(channel_username)
+
+    # Ограничение на одновременные выгрузки комментариев по всем каналам; каждый аккаунт пула добавляет воркеров
+    accounts_count = len(session_pool.accounts)
+    replies_semaphore = asyncio.Semaphore(replies_workers * accounts_count)
+    workers_count = max(1, min(parser_workers * accounts_count, queue.qsize()))
+    await asyncio.gather(*[
+        channel_worker(queue, limit, replies_semaphore, incremental) for _ in range(workers_count)
+    ])
+    await run_io(save_text_atomic, channels_state_file, json.dumps(channels_state))
+    logging.info(f"Сэкономлено запросов к Telegram за запуск: {saved_requests_count}")
+
+async def parse_chat_members(account, chat_id):
+    chats_progress[chat_id] = 0
+    try:
+        members = limited_iter(
+            account.limiters['members'],
+            lambda yielded, last: skip_items(account.client.get_chat_members(chat_id), yielded, account.limiters['members'], 200),
+            page_size=200
+        )
+        async for member in members:
+            if not parsing_in_progress:
+                return
+            if register_parsed_user(member.user):
+                metrics.inc('parser_users_found_total', source=chat_id)
+            chats_progress[chat_id] += 1
+        checkpoint['done_chats'].append(chat_id)
+        logging.info(f"Чат {chat_id}: обработано {chats_progress[chat_id]} участников")
+    except ChatAdminRequired:
+        logging.warning(f"Необходимы права администратора для чата ID {chat_id}. Пропуск.")
+    except Exception as e:
+        # Ошибка одного чата не останавливает остальные
+        logging.error(f"Ошибка при парсинге чата {chat_id}: {str(e)}")
+
+async def parse_chats():
+    chats_progress.clear()
+    semaphore = asyncio.Semaphore(chat_workers * len(session_pool.accounts))
+
+    async def parse_with_limit(chat_id):
+        async with semaphore:
+            if parsing_in_progress:
+                async with session_pool.lease('members') as account:
+                    await parse_chat_members(account, chat_id)
+
+    await asyncio.gather(*[
+        parse_with_limit(chat_id) for chat_id in chats if chat_id not in checkpoint['done_chats']
+    ])
+
+async def write_checkpoint():
+    # Состояние сериализуется в цикле событий, пока его никто не меняет, а пишется на диск в потоке.
+    # Пачка пользователей снимается в тот же момент: в базу до этой контрольной точки попадут ровно те,
+    # кто учтен в ее new_users, иначе после сбоя пропущенные новые пользователи сочтутся известными
+    batch = users.detach()
+    checkpoint['new_users'] = list(new_users)
+    # Увиденные за запуск id: после продолжения они не посчитаются второй раз
+    checkpoint['parsed_user_ids'] = list(parsed_user_ids)
+    state_text = json.dumps(channels_state)
+    checkpoint_text = json.dumps(checkpoint)
+
+    def write():
+        users.flush(batch)
+        users.save_index()
+        save_text_atomic(channels_state_file, state_text)
+        save_text_atomic(checkpoint_file, checkpoint_text)
+    await run_io(write)
+
+async def run_checkpointer():
+    last_time = time.monotonic()
+    while parsing_in_progress:
+        await asyncio.sleep(1)
+        if len(users.dirty) >= checkpoint_users or time.monotonic() - last_time >= checkpoint_interval:
+            await write_checkpoint()
+            last_time = time.monotonic()
+
+async def execute_parsing(limit=50, incremental=True, with_chats=True, resume=False, kind='manual'):
+    global users, new_users, checkpoint, parsed_users_count
+    metrics.start_run()
+    # База загружается один раз и живет между запусками: в нее же пишет handle_message,
+    # поэтому перечитывание с диска потеряло бы еще не сохраненных пользователей
+    if users is None:
+        with metrics.timer('parser_storage_seconds', op='load'):
+            users = await run_io(load_users)
+    new_users = set()
+    parsed_user_ids.clear()
+    saved = await run_io(load_checkpoint) if resume else {}
+    if saved and kind == 'auto' and saved.get('kind') != 'auto':
+        # Автопарсер продолжает только свои запуски: ручной полный парсинг хранит другое окно и режим
+        logging.info(f"Контрольная точка от {saved['started']} оставлена ручным запуском, автопарсер начинает заново")
+        saved = {}
+    if saved:
+        checkpoint = saved
+        new_users = set(checkpoint['new_users'])
+        parsed_user_ids.update(checkpoint.get('parsed_user_ids', []))
+        # Счетчик растет ровно вместе с множеством увиденных id, поэтому восстанавливаем его по множеству
+        parsed_users_count = len(parsed_user_ids)
+        logging.info(f"Продолжение парсинга с контрольной точки от {checkpoint['started']}")
+    else:
+        checkpoint = {
+            'started': datetime.now().strftime('%d.%m.%Y %H:%M'),
+            'kind': kind,
+            'limit': limit,
+            'incremental': incremental,
+            'with_chats': with_chats,
+            'cursors': {},
+            'done_channels': [],
+            'done_chats': [],
+            'new_users': []
+        }
+    checkpoint_task = asyncio.create_task(run_checkpointer())
+    finished = False
+    try:
+        # Клиенты пула подключены при старте бота; при выдаче аккаунта пропавшее соединение поднимается заново
+        await parse_channels(limit=checkpoint['limit'], incremental=checkpoint['incremental'])
+        if checkpoint['with_chats']:
+            await parse_chats()
+        finished = True
+    finally:
+        checkpoint_task.cancel()
+        metrics.finish_run()
+        await run_io(save_users, users)
+        await run_io(save_new_users, set(new_users))
+        if new_users:
+            try:
+                await run_io(snapshot_new_users)
             except Exception as e:
-                logging.error(f"Произошла ошибка: {str(e)}")
-
-async def parse_chat_members(chat_id):
-    global parsed_users_count
-    async with app:
+                logging.error(f"Не удалось сохранить снимок новых пользователей: {str(e)}")
+        if finished and parsing_in_progress:
+            await run_io(clear_checkpoint)
+        else:
+            # Парсинг остановлен или прерван ошибкой: оставляем контрольную точку для продолжения
+            await write_checkpoint()
         try:
-            async for member in app.get_chat_members(chat_id):
-                user_id = member.user.id
-                users.add(user_id)
-                if user_id not in info_users:
-                    new_users.add(user_id)
-                update_user_info(user_id, member.user.username, member.user.phone_number)
-                async with parsed_users_count_lock:
-                    parsed_users_count += 1
-        except ChatAdminRequired:
-            logging.warning(f"Необходимы права администратора для чата ID {chat_id}. Пропуск.")
-        except FloodWait as e:
-            logging.warning(f"Достигнут лимит запросов. Ожидание {e.value} секунд.")
-            await asyncio.sleep(e.value)
+            await run_io(save_text_atomic, metrics_file, metrics.render())
+        except Exception as e:
+            logging.warning(f"Не удалось сохранить метрики: {str(e)}")
 
 @dp.message_handler(commands=['start'])
 async def send_welcome(message: types.Message):
@@ -263,136 +1608,254 @@ async def send_welcome(message: types.Message):
     else:
         await show_main_menu(message.from_user.id)
 
-async def update_main_menu_text(user_id):
+class ProgressReporter:
+    # Редактирует подпись сообщения с прогрессом: только когда изменились значения и не чаще min_interval.
+    # render() возвращает (значения, подпись); ошибки Bot API не останавливают ни репортер, ни парсинг
+    def __init__(self, chat_id, message_id, render, reply_markup=None, min_interval=progress_interval):
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.render = render
+        self.reply_markup = reply_markup
+        self.min_interval = min_interval
+        self.last_values = None
+        self.next_update = 0
+        self.stopped = None
+        self.task = None
+
+    def start(self):
+        self.stopped = asyncio.Event()
+        self.task = asyncio.create_task(self.run())
+        return self
+
+    async def run(self):
+        while not self.stopped.is_set():
+            await self.update()
+            delay = max(self.next_update - time.monotonic(), self.min_interval)
+            try:
+                await asyncio.wait_for(self.stopped.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+    async def update(self):
+        if self.message_id is None or time.monotonic() < self.next_update:
+            return
+        values, caption = self.render()
+        if values == self.last_values:
+            return
+        try:
+            await bot.edit_message_caption(
+                chat_id=self.chat_id,
+                message_id=self.message_id,
+                caption=caption,
+                reply_markup=self.reply_markup
+            )
+            self.last_values = values
+        except MessageNotModified:
+            self.last_values = values
+        except RetryAfter as e:
+            self.next_update = time.monotonic() + e.timeout
+        except Exception as e:
+            logging.warning(f"Не удалось обновить прогресс: {str(e)}")
+
+    async def stop(self, final=False):
+        if self.task is None:
+            return
+        self.stopped.set()
+        await self.task
+        self.task = None
+        if final:
+            # Итоговые значения показываем сразу, не дожидаясь интервала
+            self.next_update = 0
+            await self.update()
+
+def main_menu_caption():
     user_count = len(users)
     last_parsed_count = len(new_users)
-    while parsing_in_progress:
-        await bot.edit_message_caption(
-            chat_id=user_id,
-            message_id=main_menu_message_id,
-            caption=f"Главное меню:\n\nВ базе: {user_count} чел\nСпарсено за последний раз: {last_parsed_count} чел"
-        )
-        await asyncio.sleep(5)
+    return f"Главное меню:\n\nВ базе: {user_count} чел\nСпарсено за последний раз: {last_parsed_count} чел"
+
+def render_main_menu():
+    return (len(users), len(new_users)), main_menu_caption()
 
 @dp.callback_query_handler(lambda c: c.data == 'stop_parsing')
 async def stop_parsing(callback_query: types.CallbackQuery):
-    global parsing_in_progress
     await bot.answer_callback_query(callback_query.id)
-    if parsing_in_progress:
-        parsing_in_progress = False
+    if job_queue.current:
+        job_queue.cancel(job_queue.current.id)
         await bot.send_message(callback_query.from_user.id, "Парсинг остановлен по запросу пользователя.")
     else:
         await bot.send_message(callback_query.from_user.id, "Парсинг не выполняется.")
 
-async def check_and_save_new_users_file():
-    previous_size = None
-    while True:
-        # Ждем 1 минуту и 3 секунды перед следующей проверкой
-        await asyncio.sleep(60)
-
-        # Проверяем, существует ли файл new_users.json
-        if os.path.exists('new_users.json'):
-            # Получаем текущий размер файла
-            current_size = os.path.getsize('new_users.json')
-
-            # Если размер файла изменился
-            if current_size != previous_size:
-                # Получаем текущую дату и время
-                current_time = datetime.now().strftime("%d_%m_%Y_%H_%M")
-
-                # Создаем папку newFILES, если она не существует
-                if not os.path.exists('newFILES'):
-                    os.makedirs('newFILES')
-
-                new_file_name = f"{current_time}.json"                          # JSON
-                new_file_path = os.path.join('newFILES', new_file_name)
-
-                with open('new_users.json', 'r') as original_file:
-                    with open(new_file_path, 'w') as new_file:
-                        new_file.write(original_file.read())
-
-                print(f"Создана копия файла new_users.json: {new_file_path}")
-
-                if os.path.exists('converted_new_users.txt'):
-                    converted_file_name = f"{current_time}.txt"                # TXT
-                    converted_file_path = os.path.join('newFILES', converted_file_name)
-
-                    # Копируем содержимое файла converted_new_users.txt в новый файл
-                    with open('converted_new_users.txt', 'r') as original_converted_file:
-                        with open(converted_file_path, 'w') as new_converted_file:
-                            new_converted_file.write(original_converted_file.read())
-
-                    print(f"Создана копия файла converted_new_users.txt: {converted_file_path}")
+def link_or_copy(src_path, dst_path):
+    # Жесткая ссылка не копирует данные; если ФС ее не поддерживает, копируем потоково
+    if os.path.exists(dst_path):
+        os.remove(dst_path)
+    try:
+        os.link(src_path, dst_path)
+    except OSError:
+        shutil.copyfile(src_path, dst_path)
+
+def snapshot_new_users():
+    # Снимок new_users.json и его txt-выгрузки в newFILES, делается по завершении парсинга
+    os.makedirs(snapshots_dir, exist_ok=True)
+    current_time = datetime.now().strftime("%d_%m_%Y_%H_%M")
+
+    json_path = os.path.join(snapshots_dir, f"{current_time}.json")
+    if snapshot_gzip:
+        json_path += '.gz'
+        with open(new_users_file, 'rb') as original_file, gzip.open(json_path, 'wb') as new_file:
+            shutil.copyfileobj(original_file, new_file)
+    else:
+        link_or_copy(new_users_file, json_path)
+    logging.info(f"Создана копия файла new_users.json: {json_path}")
 
-                # Обновляем предыдущий размер файла
-                previous_size = current_size
-        else:
-            print("Новых людей в базе нет.")
+    # ID всех новых пользователей добавляются в конец файла, как в converted_new_users.txt
+    txt_path = export_users(
+        iter_json_lines(new_users_file), os.path.join(snapshots_dir, f"{current_time}.txt"),
+        ids='all', compress=snapshot_gzip
+    )
+    logging.info(f"Создана выгрузка новых пользователей: {txt_path}")
 
 @dp.callback_query_handler(lambda c: c.data == 'convert')
 async def process_convert(callback_query: types.CallbackQuery):
     await bot.answer_callback_query(callback_query.id)
     await convert_and_send_files(callback_query.from_user.id)
 
+def format_user_line(user_data, separator=' ', require_username=False):
+    # Общий формат "@username phone" для всех выгрузок
+    username = f"@{user_data['username']}" if user_data.get('username') else ''
+    phone = user_data.get('phone') or ''
+    if require_username and not username:
+        return None
+    if not username and not phone:
+        return None
+    return f"{username}{separator}{phone}"
+
+def iter_json_lines(path):
+    with open(path, 'r') as f:
+        for line in f:
+            yield json_loads(line)
+
+def format_export_block(records, separator=' ', require_username=False, ids=None, export_format='txt'):
+    # Кусок выгрузки целиком: текст строк и текст хвостовой секции id.
+    # ids: None - без секции id, 'all' - id всех записей, 'matched' - только попавших в выгрузку
+    lines, id_lines = [], []
+    if export_format == 'csv':
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        for user_data in records:
+            if format_user_line(user_data, require_username=require_username) is not None:
+                writer.writerow([user_data.get('user_id', ''), user_data.get('username') or '', user_data.get('phone') or ''])
+        return buffer.getvalue(), ''
+
+    for user_data in records:
+        line = format_user_line(user_data, separator, require_username)
+        if line is not None:
+            lines.append(line + '\n')
+        if user_data.get('user_id') and (ids == 'all' or ids == 'matched' and line is not None):
+            id_lines.append(f"{user_data['user_id']}\n")
+    return ''.join(lines), ''.join(id_lines)
+
+def iter_batches(items, size=10000):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def export_users(records, path, separator=' ', require_username=False, ids=None, export_format='txt', compress=False):
+    blocks = (
+        format_export_block(batch, separator, require_username, ids, export_format)
+        for batch in iter_batches(records)
+    )
+    return write_export(blocks, path, export_format, compress)
+
+def write_export(blocks, path, export_format='txt', compress=False):
+    # Один проход по источнику: строки пишутся сразу в файл, id для хвостовой секции копятся во временном файле
+    if export_format == 'csv':
+        path = os.path.splitext(path)[0] + '.csv'
+    if compress:
+        path += '.gz'
+    opener = gzip.open if compress else open
+    with opener(path, 'wt', encoding='utf-8', newline='') as f:
+        if export_format == 'csv':
+            csv.writer(f).writerow(['user_id', 'username', 'phone'])
+        with tempfile.TemporaryFile('w+', encoding='utf-8') as ids_file:
+            for text, ids_text in blocks:
+                f.write(text)
+                ids_file.write(ids_text)
+            ids_file.seek(0)
+            shutil.copyfileobj(ids_file, f)
+    return path
+
+def export_base(store, path, separator=' ', require_username=False, ids=None, export_format='txt', compress=False):
+    # Большую базу разбираем в нескольких процессах, маленькую - как обычно, без накладных расходов на пул
+    if bulk_workers > 1 and store.size >= bulk_min_size:
+        blocks = store.iter_export_blocks(separator, require_username, ids, export_format)
+        return write_export(blocks, path, export_format, compress)
+    return export_users(store.iter_records(), path, separator, require_username, ids, export_format, compress)
+
+def map_file(path):
+    # Отображение файла в память только для чтения; дескриптор после этого не нужен
+    with open(path, 'rb') as f:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+def split_chunks(path, size, chunk_size):
+    # Границы кусков файла, выровненные по концам строк
+    chunks = []
+    if size == 0:
+        return chunks
+    with map_file(path) as view:
+        start = 0
+        while start < size:
+            end = start + chunk_size
+            if end < size:
+                end = view.find(b'\n', end) + 1 or size
+            end = min(end, size)
+            chunks.append((start, end))
+            start = end
+    return chunks
+
+def convert_chunk(path, offsets, separator, require_username, ids, export_format):
+    # Выполняется в дочернем процессе: из отображенного журнала разбираются только актуальные записи (offsets)
+    with map_file(path) as view:
+        records = [json_loads(view[offset:view.find(b'\n', offset)]) for offset in offsets]
+    return format_export_block(records, separator, require_username, ids, export_format)
+
 async def convert_and_send_files(user_id):
     # Конвертация full_base.json
-    converted_data = []
     try:
-        with open(full_base_file, 'r') as f:
-            for line in f:
-                user_data = json.loads(line)
-                username = f"@{user_data.get('username', '')}" if user_data.get('username') else ''
-                phone = user_data.get('phone', '') if user_data.get('phone') else ''
-                if username or phone:
-                    converted_data.append(f"{username} {phone}")
+        path = await run_io(
+            export_base, users, converted_full_base_file,
+            export_format=export_format, compress=export_gzip
+        )
     except FileNotFoundError:
         await bot.send_message(user_id, "Файл full_base.json не найден.")
         return
 
-    # Сохранение конвертированных данных в файл
-    with open('converted_full_base.txt', 'w') as f:
-        for line in converted_data:
-            f.write(line + '\n')
-
     # Отправка конвертированного файла
-    with open('converted_full_base.txt', 'rb') as f:
+    with open(path, 'rb') as f:
         await bot.send_document(user_id, f)
 
     # Конвертация new_users.json
-    converted_data = []
-    user_ids = []
     try:
         if os.path.getsize(new_users_file) == 0:
             logging.info("Файл new_users.json пуст.")
             await bot.send_message(user_id, "Файл new_users.json пуст.")
             return
 
-        with open(new_users_file, 'r') as f:
-            for line in f:
-                user_data = json.loads(line)
-                username = f"@{user_data.get('username', '')}" if user_data.get('username') else ''
-                phone = user_data.get('phone', '') if user_data.get('phone') else ''
-                user_id_value = user_data.get('user_id', '')
-                if username or phone:
-                    converted_data.append(f"{username} {phone}")
-                if user_id_value:
-                    user_ids.append(str(user_id_value))
+        # ID всех новых пользователей добавляются в конец файла
+        await run_io(export_users, iter_json_lines(new_users_file), converted_new_users_file, ids='all')
     except FileNotFoundError:
         logging.error("Файл new_users.json не найден.")
         await bot.send_message(user_id, "Файл new_users.json не найден.")
         return
 
-    # Добавление ID в конец файла
-    converted_data.extend(user_ids)
-
-    # Сохранение конвертированных данных в файл
-    with open('converted_new_users.txt', 'w') as f:
-        for line in converted_data:
-            f.write(line + '\n')
-
     # Отправка конвертированного файла
     try:
-        with open('converted_new_users.txt', 'rb') as f:
+        with open(converted_new_users_file, 'rb') as f:
             await bot.send_document(user_id, f)
     except Exception as e:
         logging.error(f"Ошибка при отправке файла: {e}")
@@ -402,15 +1865,16 @@ main_menu_message_id = None
 
 async def show_main_menu(user_id: int):
     global main_menu_message_id
-    user_count = len(users)
-    last_parsed_count = len(new_users)
     keyboard = InlineKeyboardMarkup()
     keyboard.add(InlineKeyboardButton("Начать парсинг", callback_data='pars'))
+    if os.path.exists(checkpoint_file):
+        keyboard.add(InlineKeyboardButton("Продолжить парсинг", callback_data='resume_pars'))
     keyboard.add(InlineKeyboardButton("Полный парсинг канала", callback_data='full_pars_ch'))
     keyboard.add(InlineKeyboardButton("Автономный парсер", callback_data='auto_parser'))
+    keyboard.add(InlineKeyboardButton("Задания", callback_data='jobs'))
     keyboard.add(InlineKeyboardButton("Настройки", callback_data='settings'))
     keyboard.add(InlineKeyboardButton("Файлы", callback_data='files'))
-    main_menu_message = await bot.send_photo(user_id, photo=open('images/main.jpg', 'rb'), caption=f"Главное меню:\n\nВ базе: {user_count} чел\nСпарсено за последний раз: {last_parsed_count} чел", reply_markup=keyboard)
+    main_menu_message = await send_image(user_id, 'main.jpg', caption=main_menu_caption(), reply_markup=keyboard)
     main_menu_message_id = main_menu_message.message_id
 
 def get_cancel_keyboard():
@@ -425,8 +1889,19 @@ async def process_settings(callback_query: types.CallbackQuery):
     keyboard.add(InlineKeyboardButton("Администрация", callback_data='admin'))
     keyboard.add(InlineKeyboardButton("Каналы", callback_data='channels'))
     keyboard.add(InlineKeyboardButton("Чаты", callback_data='chats'))
+    keyboard.add(InlineKeyboardButton(
+        f"Профилирование: {'вкл' if profiling_enabled else 'выкл'}", callback_data='toggle_profiling'
+    ))
     keyboard.add(InlineKeyboardButton("Закрыть", callback_data='close'))
-    await bot.send_photo(callback_query.from_user.id, photo=open('images/settings.jpg', 'rb'), caption="Настройки:", reply_markup=keyboard)
+    await send_image(callback_query.from_user.id, 'settings.jpg', caption="Настройки:", reply_markup=keyboard)
+
+@dp.callback_query_handler(lambda c: c.data == 'toggle_profiling')
+async def toggle_profiling(callback_query: types.CallbackQuery):
+    global profiling_enabled
+    await bot.answer_callback_query(callback_query.id)
+    profiling_enabled = not profiling_enabled
+    status = "включено: следующие запуски парсинга будут профилироваться" if profiling_enabled else "выключено"
+    await bot.send_message(callback_query.from_user.id, f"Профилирование {status}")
 
 @dp.callback_query_handler(lambda c: c.data == 'admin')
 async def process_admin(callback_query: types.CallbackQuery):
@@ -436,7 +1911,7 @@ async def process_admin(callback_query: types.CallbackQuery):
     keyboard.add(InlineKeyboardButton("Добавить", callback_data='add_acs'))
     keyboard.add(InlineKeyboardButton("Удалить", callback_data='del_acs'))
     keyboard.add(InlineKeyboardButton("Закрыть", callback_data='close'))
-    await bot.send_photo(callback_query.from_user.id, photo=open('images/admin.jpg', 'rb'), caption=f"Администраторы:\n{admins}", reply_markup=keyboard)
+    await send_image(callback_query.from_user.id, 'admin.jpg', caption=f"Администраторы:\n{admins}", reply_markup=keyboard)
 
 @dp.callback_query_handler(lambda c: c.data == 'add_acs')
 async def process_add_acs(callback_query: types.CallbackQuery):
@@ -478,7 +1953,7 @@ async def process_channels(callback_query: types.CallbackQuery):
     keyboard.add(InlineKeyboardButton("Добавить", callback_data='add_ch'))
     keyboard.add(InlineKeyboardButton("Удалить", callback_data='del_ch'))
     keyboard.add(InlineKeyboardButton("Закрыть", callback_data='close'))
-    await bot.send_photo(callback_query.from_user.id, photo=open('images/channels.jpg', 'rb'), caption=f"Каналы для парсинга:\n{channels_info}", reply_markup=keyboard, parse_mode='Markdown')
+    await send_image(callback_query.from_user.id, 'channels.jpg', caption=f"Каналы для парсинга:\n{channels_info}", reply_markup=keyboard, parse_mode='Markdown')
 
 @dp.callback_query_handler(lambda c: c.data == 'add_ch')
 async def process_add_ch(callback_query: types.CallbackQuery):
@@ -502,6 +1977,8 @@ async def process_delete_channel(callback_query: types.CallbackQuery):
     if channel in channels:
         del channels[channel]
         save_channels(channels)
+        channels_state.pop(channel, None)
+        save_channels_state(channels_state)
         await bot.send_message(callback_query.from_user.id, f"Канал {channel} удален из парсера")
     else:
         await bot.send_message(callback_query.from_user.id, f"Канал {channel} не найден в парсере")
@@ -541,6 +2018,8 @@ async def process_dellch(message: types.Message, state: FSMContext):
             if channel in channels:
                 del channels[channel]
                 save_channels(channels)
+                channels_state.pop(channel, None)
+                save_channels_state(channels_state)
                 await message.reply(f"Канал {channel} удален из парсера")
             else:
                 keyboard = InlineKeyboardMarkup().add(InlineKeyboardButton("ОК", callback_data='ok'))
@@ -558,7 +2037,7 @@ async def process_chats(callback_query: types.CallbackQuery):
     keyboard.add(InlineKeyboardButton("Добавить", callback_data='add_chat'))
     keyboard.add(InlineKeyboardButton("Удалить", callback_data='del_chat'))
     keyboard.add(InlineKeyboardButton("Закрыть", callback_data='close'))
-    await bot.send_photo(callback_query.from_user.id, photo=open('images/chats.jpg', 'rb'), caption=f"Чаты для парсинга:\n{chats_info}", reply_markup=keyboard, parse_mode='Markdown')
+    await send_image(callback_query.from_user.id, 'chats.jpg', caption=f"Чаты для парсинга:\n{chats_info}", reply_markup=keyboard, parse_mode='Markdown')
 
 @dp.callback_query_handler(lambda c: c.data == 'ok')
 async def process_ok(callback_query: types.CallbackQuery):
@@ -631,27 +2110,34 @@ async def process_dellchat(message: types.Message, state: FSMContext):
 parsed_users_count = 0  
 new_users_count = 0
 
-async def update_parsing_message(user_id, message_id, start_time):
-    global parsed_users_count, new_users_count
-    while parsing_in_progress:
+def parsing_progress_renderer(start_time):
+    def render():
         elapsed_time = int(time.time() - start_time)
         hours, remainder = divmod(elapsed_time, 3600)
         minutes, seconds = divmod(remainder, 60)
-        
+
         time_string = f"{hours} час {minutes:02d} мин {seconds:02d} сек"
-        
-        await bot.edit_message_caption(
-            chat_id=user_id,
-            message_id=message_id,
-            caption=(
-                f"Парсинг начат..\n"
-                f"Прошло времени: {time_string}\n"
-                f"Обработано пользователей: {parsed_users_count}\n"
-                f"Новые пользователи: {new_users_count}"
-            ),
-            reply_markup=get_stop_parsing_keyboard()
+
+        # Время тикает всегда, поэтому сообщение правим только при изменении счетчиков
+        values = (parsed_users_count, new_users_count)
+        return values, (
+            f"Парсинг начат..\n"
+            f"Прошло времени: {time_string}\n"
+            f"Обработано пользователей: {parsed_users_count}\n"
+            f"Новые пользователи: {new_users_count}"
         )
-        await asyncio.sleep(1)
+    return render
+
+def start_progress_reporters(user_id, message_id, start_time):
+    return [
+        ProgressReporter(user_id, main_menu_message_id, render_main_menu).start(),
+        ProgressReporter(user_id, message_id, parsing_progress_renderer(start_time), get_stop_parsing_keyboard()).start()
+    ]
+
+async def stop_progress_reporters(reporters):
+    menu_reporter, parsing_reporter = reporters
+    await parsing_reporter.stop()
+    await menu_reporter.stop(final=True)
 
 @dp.callback_query_handler(lambda c: c.data == 'pars')
 async def process_pars(callback_query: types.CallbackQuery):
@@ -666,8 +2152,7 @@ async def process_pars(callback_query: types.CallbackQuery):
     keyboard.add(InlineKeyboardButton("Отмена", callback_data='cancel'))
 
     #await bot.send_message(user_id, f"Ссылки на каналы/чаты:\n\n{channels_info}\n{chats_info}\n\nПодтвердить запуск?", reply_markup=keyboard, parse_mode='Markdown', disable_web_page_preview=True)
-    with open('images/links.jpg', 'rb') as photo:
-        await bot.send_photo(user_id, photo, caption=f"Ссылки на каналы/чаты:\n\n{channels_info}\n{chats_info}\n\nПодтвердить запуск?", reply_markup=keyboard, parse_mode='Markdown')
+    await send_image(user_id, 'links.jpg', caption=f"Ссылки на каналы/чаты:\n\n{channels_info}\n{chats_info}\n\nПодтвердить запуск?", reply_markup=keyboard, parse_mode='Markdown')
 
 @dp.callback_query_handler(lambda c: c.data == 'parsing_stats')
 async def show_parsing_stats(callback_query: types.CallbackQuery):
@@ -690,60 +2175,208 @@ async def stop_parsing_handler(callback_query: types.CallbackQuery):
     else:
         await bot.send_message(callback_query.from_user.id, "Парсинг не выполняется.")
 
-@dp.callback_query_handler(lambda c: c.data == 'confirm_pars')
-async def confirm_pars(callback_query: types.CallbackQuery):
-    global parsing_in_progress, parsed_users_count
-    await bot.answer_callback_query(callback_query.id)
-    user_id = callback_query.from_user.id
-    
-    if parsing_in_progress:
-        keyboard = InlineKeyboardMarkup()
-        keyboard.add(InlineKeyboardButton("⛔️Остановить парсинг", callback_data='stop_parsing'))
-        keyboard.add(InlineKeyboardButton("❌Закрыть", callback_data='close'))
-        await bot.send_message(user_id, "Парсинг уже выполняется. Пожалуйста, дождитесь его завершения.", reply_markup=keyboard)
-        return
+class RunProfiler:
+    # Профиль одного запуска: yappi по настенному времени (видит корутины и все потоки),
+    # без него - cProfile из стандартной библиотеки (только основной поток)
+    def __init__(self, name):
+        self.name = name
+        self.profiler = None
+
+    def start(self):
+        if yappi:
+            yappi.clear_stats()
+            yappi.set_clock_type('wall')
+            yappi.start()
+        else:
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+
+    def stop(self):
+        if yappi:
+            yappi.stop()
+        else:
+            self.profiler.disable()
+
+    def save(self):
+        # Профиль сохраняется в формате pstats: его открывают snakeviz, gprof2dot и python -m pstats
+        os.makedirs(profiles_dir, exist_ok=True)
+        path = os.path.join(profiles_dir, f"{self.name}_{datetime.now().strftime('%Y_%m_%d_%H_%M')}.prof")
+        if yappi:
+            yappi.get_func_stats().save(path, type='pstat')
+        else:
+            self.profiler.dump_stats(path)
+        return path, profile_summary(path)
+
+def profile_summary(path, top=None):
+    # Самые затратные функции по собственному времени
+    stats = pstats.Stats(path).stats
+    rows = sorted(stats.items(), key=lambda item: item[1][2], reverse=True)[:top or profile_top]
+    lines = [f"{'собств':>8} {'всего':>8} {'вызовы':>8}  функция"]
+    for (filename, line, func), (cc, nc, tt, ct, callers) in rows:
+        lines.append(f"{tt:8.2f} {ct:8.2f} {nc:>8}  {func} ({os.path.basename(filename)}:{line})")
+    return '\n'.join(lines)
+
+async def run_profiled(job):
+    profiler = RunProfiler(f"job{job.id}")
+    profiler.start()
+    try:
+        await job.run(job)
+    finally:
+        profiler.stop()
+        try:
+            path, summary = await run_io(profiler.save)
+            await bot.send_message(
+                job.user_id,
+                f"Профиль задания #{job.id}: {path}\n<pre>{html.escape(summary[:3500], quote=False)}</pre>",
+                parse_mode='HTML'
+            )
+        except Exception as e:
+            logging.warning(f"Не удалось сохранить профиль задания #{job.id}: {str(e)}")
+
+class ParseJob:
+    def __init__(self, job_id, kind, title, user_id, run, params, priority, seq):
+        self.id = job_id
+        self.kind = kind            # 'manual' - запущено админом, 'auto' - автономным парсером
+        self.title = title
+        self.user_id = user_id
+        self.run = run
+        self.params = params
+        self.priority = priority
+        self.seq = seq
+        self.status = 'queued'
+
+class JobQueue:
+    # Запуски парсинга выполняются по одному из очереди с приоритетами; меньший приоритет идет раньше.
+    # Переприоритизация кладет в очередь новую запись, устаревшие записи пропускаются при извлечении
+    priorities = {'manual': 0, 'auto': 10}
+
+    def __init__(self):
+        self.queue = None
+        self.jobs = {}
+        self.current = None
+        self.next_id = 1
+        self.seq = 0
+
+    def push(self, job):
+        self.seq += 1
+        job.seq = self.seq
+        self.queue.put_nowait((job.priority, job.seq, job.id))
+        metrics.set('parser_jobs_queued', len(self.pending()))
+
+    def submit(self, kind, title, user_id, run, **params):
+        # Такое же задание уже ждет в очереди - второй раз не ставим
+        for job in self.pending():
+            if job.kind == kind and job.run is run and job.params == params:
+                return job
+        job = ParseJob(self.next_id, kind, title, user_id, run, params, self.priorities[kind], 0)
+        self.next_id += 1
+        self.jobs[job.id] = job
+        self.push(job)
+        logging.info(f"Задание #{job.id} ({job.title}) добавлено в очередь")
+        return job
+
+    def pending(self):
+        return sorted((job for job in self.jobs.values() if job.status == 'queued'), key=lambda job: (job.priority, job.seq))
+
+    def position(self, job):
+        return self.pending().index(job) + 1 if job.status == 'queued' else 0
+
+    def raise_priority(self, job_id):
+        job = self.jobs.get(job_id)
+        if job is None or job.status != 'queued':
+            return False
+        job.priority = min(other.priority for other in self.pending()) - 1
+        self.push(job)
+        return True
+
+    def cancel(self, job_id):
+        global parsing_in_progress
+        job = self.jobs.get(job_id)
+        if job is None:
+            return False
+        if job is self.current:
+            # Текущий парсинг останавливается штатно и оставляет контрольную точку
+            parsing_in_progress = False
+        job.status = 'cancelled'
+        if job is not self.current:
+            del self.jobs[job_id]
+        return True
+
+    async def worker(self):
+        global parsing_in_progress
+        self.queue = asyncio.PriorityQueue()
+        while True:
+            priority, seq, job_id = await self.queue.get()
+            job = self.jobs.get(job_id)
+            if job is None or job.status != 'queued' or job.seq != seq:
+                continue
+            metrics.set('parser_jobs_queued', len(self.pending()) - 1)
+            self.current = job
+            job.status = 'running'
+            parsing_in_progress = True
+            logging.info(f"Запуск задания #{job.id} ({job.title})")
+            try:
+                # Без профилирования запуск ничем не обернут
+                await (run_profiled(job) if profiling_enabled else job.run(job))
+                if job.status == 'running':
+                    job.status = 'done'
+            except Exception as e:
+                job.status = 'failed'
+                logging.error(f"Задание #{job.id} завершилось с ошибкой: {str(e)}")
+            finally:
+                parsing_in_progress = False
+                self.current = None
+                del self.jobs[job.id]
+
+job_queue = JobQueue()
+
+job_statuses = {'queued': 'в очереди', 'running': 'выполняется', 'cancelled': 'отменяется'}
+
+async def notify_job_queued(user_id, job):
+    if job.status == 'queued' and job_queue.current:
+        await bot.send_message(user_id, f"Задание #{job.id} ({job.title}) в очереди, позиция: {job_queue.position(job)}")
+    else:
+        await bot.send_message(user_id, f"Задание #{job.id} ({job.title}) принято")
 
+async def run_parse_job(job):
+    global parsed_users_count, new_users_count
+    user_id = job.user_id
     parsed_users_count = 0  # сброс с канавы
     new_users_count = 0
-    parsing_in_progress = True
-    
-    parsing_message = await bot.send_photo(
+
+    parsing_message = await send_image(
         user_id,
-        photo=open('images/stats.jpg', 'rb'),
+        'stats.jpg',
         caption="Парсинг начат",
         reply_markup=get_stop_parsing_keyboard()
     )
-    
-    start_time = time.time()
-
-    asyncio.create_task(update_main_menu_text(user_id))
-
-    asyncio.create_task(update_parsing_message(user_id, parsing_message.message_id, start_time))
 
-    global users, new_users, info_users
-    users = load_users()
-    new_users = set()
-    await parse_channels(limit=50)
-    for chat_id in chats:
-        await parse_chat_members(chat_id)
-    save_users(users)
-    save_new_users(new_users)
+    start_time = time.time()
 
-    parsing_in_progress = False
+    reporters = start_progress_reporters(user_id, parsing_message.message_id, start_time)
+    try:
+        await execute_parsing(**job.params)
+    finally:
+        await stop_progress_reporters(reporters)
 
-    summary_message = (
-        f"<b>Всего пользователей:</b> {len(users)}\n"
-        f"<b>Новые пользователи:</b> {len(new_users)}\n"
-        f"<b>Парсинг завершен:</b> {datetime.now().strftime('%d.%m.%Y:%H:%M')}"
-    )
+    summary_message = summary_caption()
     keyboard = InlineKeyboardMarkup()
     keyboard.add(InlineKeyboardButton("Получить файл", callback_data='convert'))
-    await bot.send_photo(user_id, photo=open('images/done.jpg', 'rb'), caption=summary_message, parse_mode='HTML', reply_markup=keyboard)
+    await send_image(user_id, 'done.jpg', caption=summary_message, parse_mode='HTML', reply_markup=keyboard)
 
     await bot.delete_message(user_id, parsing_message.message_id)
 
     new_users_count = 0
 
+@dp.callback_query_handler(lambda c: c.data in ('confirm_pars', 'resume_pars'))
+async def confirm_pars(callback_query: types.CallbackQuery):
+    await bot.answer_callback_query(callback_query.id)
+    user_id = callback_query.from_user.id
+    resume = callback_query.data == 'resume_pars'
+    title = "продолжение парсинга" if resume else "парсинг"
+    job = job_queue.submit('manual', title, user_id, run_parse_job, limit=50, resume=resume)
+    await notify_job_queued(user_id, job)
+
 @dp.callback_query_handler(lambda c: c.data == 'full_pars_ch')
 async def process_full_pars_ch(callback_query: types.CallbackQuery):
     await bot.answer_callback_query(callback_query.id)
@@ -755,70 +2388,44 @@ async def process_full_pars_ch(callback_query: types.CallbackQuery):
 
 @dp.callback_query_handler(lambda c: c.data.startswith('full_pars_'))
 async def process_full_pars_channel(callback_query: types.CallbackQuery):
-    global parsing_in_progress, parsed_users_count
     await bot.answer_callback_query(callback_query.id)
     user_id = callback_query.from_user.id
-
-    if parsing_in_progress:
-        keyboard = InlineKeyboardMarkup()
-        keyboard.add(InlineKeyboardButton("⛔️Остановить парсинг", callback_data='stop_parsing'))
-        keyboard.add(InlineKeyboardButton("❌Закрыть", callback_data='close'))
-        await bot.send_message(user_id, "Парсинг уже выполняется. Пожалуйста, дождитесь его завершения.", reply_markup=keyboard)
-        return
-
-    parsed_users_count = 0
-
     channel = callback_query.data.split('_')[-1]
-    user_id = callback_query.from_user.id
-    await bot.send_message(user_id, f"Начало полного парсинга канала {channel}...")
-    
-    parsing_message = await bot.send_photo(
-        user_id,
-        photo=open('images/stats.jpg', 'rb'),
-        caption="Парсинг начат",
-        reply_markup=get_stop_parsing_keyboard()
+    # Парсинг всех постов
+    job = job_queue.submit(
+        'manual', f"полный парсинг {channel}", user_id, run_parse_job,
+        limit=None, incremental=False, with_chats=False
     )
-    
-    start_time = time.time()
-
-    new_users_count = 0
-    parsing_in_progress = True
-    asyncio.create_task(update_main_menu_text(user_id))
-
-    asyncio.create_task(update_parsing_message(user_id, parsing_message.message_id, start_time))
-
-    global users, new_users, info_users
-    users = load_users()
-    new_users = set()
-    #info_users = {}
-    await parse_channels(limit=None)  # Парсинг всех постов
-    save_users(users)
-    save_new_users(new_users)
-
-    parsing_in_progress = False
+    await notify_job_queued(user_id, job)
 
-    summary_message = (
-        f"<b>Всего пользователей:</b> {len(users)}\n"
-        f"<b>Новые пользователи:</b> {len(new_users)}\n"
-        f"<b>Парсинг завершен:</b> {datetime.now().strftime('%d.%m.%Y:%H:%M')}"
-    )
+@dp.callback_query_handler(lambda c: c.data == 'jobs')
+async def process_jobs(callback_query: types.CallbackQuery):
+    await bot.answer_callback_query(callback_query.id)
+    jobs = ([job_queue.current] if job_queue.current else []) + job_queue.pending()
     keyboard = InlineKeyboardMarkup()
-    keyboard.add(InlineKeyboardButton("Конвертировать", callback_data='convert'))
-    await bot.send_photo(user_id, photo=open('images/done.jpg', 'rb'), caption=summary_message, parse_mode='HTML', reply_markup=keyboard)
-
-    # Отправляем файлы, если они не пусты
-    #with open(full_base_file, 'rb') as f:
-    #    await bot.send_document(user_id, f)
-    
-  #  if os.path.getsize(new_users_file) > 0:
- #       with open(new_users_file, 'rb') as f:
-  #          await bot.send_document(user_id, f)
-#    else:
-   #     await bot.send_message(user_id, "Файл new_users.json пуст.")
-
-    await bot.delete_message(user_id, parsing_message.message_id)
+    for job in jobs:
+        buttons = [InlineKeyboardButton(f"❌ #{job.id}", callback_data=f'job_cancel_{job.id}')]
+        if job.status == 'queued':
+            buttons.append(InlineKeyboardButton(f"⬆️ #{job.id}", callback_data=f'job_up_{job.id}'))
+        keyboard.row(*buttons)
+    keyboard.add(InlineKeyboardButton("Закрыть", callback_data='close'))
+    jobs_info = "\n".join(
+        f"#{job.id} {job.title} ({'авто' if job.kind == 'auto' else 'вручную'}): {job_statuses[job.status]}" for job in jobs
+    )
+    await bot.send_message(callback_query.from_user.id, f"Задания:\n{jobs_info or 'Очередь пуста'}", reply_markup=keyboard)
 
-    #await show_main_menu(user_id)
+@dp.callback_query_handler(lambda c: c.data.startswith('job_cancel_') or c.data.startswith('job_up_'))
+async def process_job_action(callback_query: types.CallbackQuery):
+    await bot.answer_callback_query(callback_query.id)
+    action, job_id = callback_query.data.rsplit('_', 1)
+    job_id = int(job_id)
+    if action == 'job_cancel':
+        done = job_queue.cancel(job_id)
+        text = f"Задание #{job_id} отменено" if done else f"Задание #{job_id} не найдено"
+    else:
+        done = job_queue.raise_priority(job_id)
+        text = f"Задание #{job_id} будет выполнено следующим" if done else f"Задание #{job_id} уже не в очереди"
+    await bot.send_message(callback_query.from_user.id, text)
 
 @dp.callback_query_handler(lambda c: c.data == 'files')
 async def process_files(callback_query: types.CallbackQuery):
@@ -828,16 +2435,16 @@ async def process_files(callback_query: types.CallbackQuery):
     keyboard.add(InlineKeyboardButton("Получить файлы", callback_data='get_files'))
     keyboard.add(InlineKeyboardButton("Удалить файлы", callback_data='dell_files'))
     keyboard.add(InlineKeyboardButton("Закрыть", callback_data='main_menu'))
-    await bot.send_photo(callback_query.from_user.id, photo=open('images/files.jpg', 'rb'), caption="Файлы:", reply_markup=keyboard)
+    await send_image(callback_query.from_user.id, 'files.jpg', caption="Файлы:", reply_markup=keyboard)
 
 @dp.callback_query_handler(lambda c: c.data == 'get_files')
 async def process_get_files(callback_query: types.CallbackQuery):
     await bot.answer_callback_query(callback_query.id)
     user_id = callback_query.from_user.id
 
-    latest_files = [file_name for file_name in get_latest_files('newFILES') if file_name.endswith('.txt')]
+    latest_files = [file_name for file_name in await run_io(get_latest_files, snapshots_dir) if file_name.endswith(('.txt', '.txt.gz'))]
     for file_name in latest_files:
-        file_path = os.path.join('newFILES', file_name)
+        file_path = os.path.join(snapshots_dir, file_name)
         with open(file_path, 'rb') as f:
             await bot.send_document(user_id, f)
 
@@ -858,49 +2465,26 @@ async def process_get_base(callback_query: types.CallbackQuery):
     await bot.answer_callback_query(callback_query.id)
     user_id = callback_query.from_user.id
 
-    txt_file = io.StringIO()
-
-    usernames = []
-    user_ids = []
-    phones = []
-
     try:
         if os.path.getsize(full_base_file) == 0:
             logging.info("Файл new_users.json пуст.")
             await bot.send_message(user_id, "Файл new_users.json пуст.")
             return
 
-        with open(full_base_file, 'r') as f:
-            for line in f:
-                user_data = json.loads(line)
-                username = f"@{user_data.get('username', '')}" if user_data.get('username') else ''
-                user_id_value = user_data.get('user_id', '')
-                phone = user_data.get('phone', '')
-                if username:  # Пропускаем записи без логина
-                    usernames.append(username)
-                    user_ids.append(user_id_value)
-                    phones.append(phone)
-
-        # Записываем логины и номера телефонов в файл
-        for username, phone in zip(usernames, phones):
-            txt_file.write(f"{username}\t{phone}\n")
-
-        # Записываем идентификаторы в файл
-        for user_id_value in user_ids:
-            txt_file.write(f"{user_id_value}\n")
-
-        # Переводим указатель в начало файла
-        txt_file.seek(0)
+        # Логины с телефонами, затем идентификаторы; записи без логина пропускаются
+        path = await run_io(
+            export_base, users, base_export_file, separator='\t', require_username=True, ids='matched',
+            export_format=export_format, compress=export_gzip
+        )
 
-        # Отправляем текстовый файл пользователю
-        await bot.send_document(user_id, ('users.txt', txt_file.getvalue().encode('utf-8')), caption="База пользователей")
+        # Отправляем файл пользователю прямо с диска
+        await bot.send_document(
+            user_id, types.InputFile(path, filename=os.path.basename(path)), caption="База пользователей"
+        )
 
     except FileNotFoundError:
         logging.error("Файл new_users.json не найден.")
         await bot.send_message(user_id, "Файл new_users.json не найден.")
-    finally:
-        # Закрываем файл
-        txt_file.close()
 
    # latest_files = [file_name for file_name in get_latest_files('newFILES') if file_name.endswith('.txt')]
     #for file_name in latest_files:
@@ -915,26 +2499,20 @@ async def process_dell_files(callback_query: types.CallbackQuery):
     keyboard.add(InlineKeyboardButton("⛔️ Удалить базу", callback_data='delete_base'))
     keyboard.add(InlineKeyboardButton("⛔️ Удалить новые", callback_data='delete_new_files'))
     keyboard.add(InlineKeyboardButton("❌ Закрыть", callback_data='close'))
-    await bot.send_photo(callback_query.from_user.id, photo=open('images/trash.jpg', 'rb'), caption="Выберите, что удалить:", reply_markup=keyboard)
+    await send_image(callback_query.from_user.id, 'trash.jpg', caption="Выберите, что удалить:", reply_markup=keyboard)
 
 @dp.callback_query_handler(lambda c: c.data == 'delete_base')
 async def delete_base(callback_query: types.CallbackQuery):
     await bot.answer_callback_query(callback_query.id)
     try:
-        os.remove(full_base_file)
+        await run_io(users.delete)
         await bot.send_message(callback_query.from_user.id, "База данных удалена.")
         
-        # Перезагрузка пользователей
-        global users
-        users = load_users()
-        
         # Обновление главного меню с новой статистикой
-        user_count = len(users)
-        last_parsed_count = len(new_users)
         await bot.edit_message_caption(
             chat_id=callback_query.from_user.id,
             message_id=main_menu_message_id,
-            caption=f"Главное меню:\n\nВ базе: {user_count} чел\nСпарсено за последний раз: {last_parsed_count} чел",
+            caption=main_menu_caption(),
             reply_markup=None
         )
     except Exception as e:
@@ -945,8 +2523,8 @@ async def delete_base(callback_query: types.CallbackQuery):
 async def delete_new_files(callback_query: types.CallbackQuery):
     await bot.answer_callback_query(callback_query.id)
     try:
-        for file_name in os.listdir('newFILES'):
-            file_path = os.path.join('newFILES', file_name)
+        for file_name in os.listdir(snapshots_dir):
+            file_path = os.path.join(snapshots_dir, file_name)
             os.remove(file_path)
         await bot.send_message(callback_query.from_user.id, "Все новые файлы удалены.")
     except Exception as e:
@@ -979,7 +2557,7 @@ async def process_auto_parser(callback_query: types.CallbackQuery):
     keyboard.add(InlineKeyboardButton("Включить/Выключить", callback_data='toggle_auto_parser'))
     keyboard.add(InlineKeyboardButton("Настроить время", callback_data='set_auto_parser_time'))
     keyboard.add(InlineKeyboardButton("Закрыть", callback_data='close'))
-    await bot.send_photo(callback_query.from_user.id, photo=open('images/auto_parser.jpg', 'rb'), caption=f"Автономный парсер:\n\nСтатус: {status}\nВремя: {time}", reply_markup=keyboard)
+    await send_image(callback_query.from_user.id, 'auto_parser.jpg', caption=f"Автономный парсер:\n\nСтатус: {status}\nВремя: {time}", reply_markup=keyboard)
 
 @dp.callback_query_handler(lambda c: c.data == 'toggle_auto_parser')
 async def toggle_auto_parser(callback_query: types.CallbackQuery):
@@ -1015,15 +2593,20 @@ async def process_auto_parser_time(message: types.Message, state: FSMContext):
         await state.finish()
         await show_main_menu(message.from_user.id)
 
-async def send_summary_message(user_id):
-    summary_message = (
+def summary_caption():
+    return (
         f"<b>Всего пользователей:</b> {len(users)}\n"
         f"<b>Новые пользователи:</b> {len(new_users)}\n"
+        f"<b>Сэкономлено запросов:</b> {saved_requests_count}\n"
+        + metrics_summary() +
         f"<b>Парсинг завершен:</b> {datetime.now().strftime('%d.%m.%Y:%H:%M')}"
     )
+
+async def send_summary_message(user_id):
+    summary_message = summary_caption()
     keyboard = InlineKeyboardMarkup()
     keyboard.add(InlineKeyboardButton("Конвертировать", callback_data='convert'))
-    await bot.send_photo(user_id, photo=open('images/done.jpg', 'rb'), caption=summary_message, parse_mode='HTML', reply_markup=keyboard)
+    await send_image(user_id, 'done.jpg', caption=summary_message, parse_mode='HTML', reply_markup=keyboard)
 
 async def send_files(user_id):
     with open(full_base_file, 'rb') as f:
@@ -1045,7 +2628,7 @@ async def schedule_auto_parser():
             next_run = now.replace(hour=scheduled_time.hour, minute=scheduled_time.minute, second=0, microsecond=0)
             if next_run <= now:
                 logging.info(f"Запуск парсера в текущее время: {next_run}")
-                await run_auto_parser()
+                job_queue.submit('auto', "автономный парсинг", admin_id, run_auto_parser)
                 next_run += timedelta(days=1)
             logging.info(f"Следующий запуск парсера запланирован на {next_run}")
             await asyncio.sleep((next_run - now).total_seconds())
@@ -1053,19 +2636,10 @@ async def schedule_auto_parser():
             logging.info("Автономный парсер выключен. Ожидание...")
             await asyncio.sleep(60)
 
-async def run_auto_parser():
-    global parsing_in_progress
+async def run_auto_parser(job):
     logging.info("Запуск автономного парсера...")
-    parsing_in_progress = True
-    global users, new_users, info_users
-    users = load_users()
-    new_users = set()
-    await parse_channels(limit=50)
-    for chat_id in chats:
-        await parse_chat_members(chat_id)
-    save_users(users)
-    save_new_users(new_users)
-    parsing_in_progress = False
+    # Если прошлый запуск оборвался, автопарсер продолжает его с контрольной точки
+    await execute_parsing(limit=50, resume=True, kind='auto')
     logging.info("Автономный парсер завершил работу.")
     
     # отправки щаоупы
@@ -1074,8 +2648,21 @@ async def run_auto_parser():
 
 async def on_startup(dp):
     logging.info("Бот запущен")
+    await session_pool.start()
+    session_pool.start_health_checks()
+    if os.path.exists(checkpoint_file):
+        logging.info("Найдена контрольная точка незавершенного парсинга, его можно продолжить из меню.")
+    asyncio.create_task(job_queue.worker())
     asyncio.create_task(schedule_auto_parser())
-    asyncio.create_task(check_and_save_new_users_file())
+    asyncio.create_task(monitor_loop_lag())
+    await start_metrics_server()
+
+async def on_shutdown(dp):
+    await session_pool.stop()
+    # Пользователи, записанные handle_message после последнего парсинга
+    if users is not None:
+        await run_io(save_users, users)
+    io_executor.shutdown(wait=True)
 
 if __name__ == '__main__':
     # Настройка логирования
@@ -1087,8 +2674,10 @@ if __name__ == '__main__':
 
     channels = load_channels()
     chats = load_chats()
+    channels_state = load_channels_state()
     users = load_users()
     acs_users = load_acs_users()
+    image_file_ids = load_image_file_ids()
     auto_parser_settings = load_auto_parser_settings()
     
-    executor.start_polling(dp, on_startup=on_startup, skip_updates=True)
\ No newline at end of file
+    executor.start_polling(dp, on_startup=on_startup, on_shutdown=on_shutdown, skip_updates=True)
\ No newline at end of file